@@ -4,10 +4,61 @@ import logging
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 
+def _is_pattern(collection):
+    return any(c in collection for c in "*?[")
+
+def resolve_collections(butler, collections):
+    """
+    Resolve the collections to search, only querying the registry for
+    patterns; named collections (including chains) are searched as given
+    """
+    if not collections:
+        logger.warning("no collections given, searching every collection in the repo")
+        return list(butler.registry.queryCollections("*"))
+    resolved = []
+    for collection in collections:
+        if _is_pattern(collection):
+            resolved.extend(butler.registry.queryCollections(collection))
+        else:
+            resolved.append(collection)
+    return resolved
+
+def associate(butler, tagged, datasets, collections, where=None, chunk_size=10000):
+    """
+    Associate the datasets found first in ``collections`` into the TAGGED
+    collection ``tagged``, skipping those it already holds
+
+    Query results are streamed and associated in chunks of ``chunk_size``.
+    Returns the number of datasets associated.
+    """
+    from lsst.daf.butler.registry import CollectionType
+
+    butler.registry.registerCollection(tagged, CollectionType.TAGGED)
+    associated = 0
+    for dataset in datasets:
+        seen = {ref.id for ref in butler.registry.queryDatasets(dataset, collections=tagged)}
+        existing = len(seen)
+        n = 0
+        chunk = []
+        for ref in butler.registry.queryDatasets(dataset, collections=collections, where=where, findFirst=True):
+            if ref.id in seen:
+                continue
+            seen.add(ref.id)
+            chunk.append(ref)
+            if len(chunk) >= chunk_size:
+                butler.registry.associate(tagged, chunk)
+                n += len(chunk)
+                chunk = []
+        if chunk:
+            butler.registry.associate(tagged, chunk)
+            n += len(chunk)
+        logger.info("associated %s of %s into %s (%s already tagged)", n, dataset, tagged, existing)
+        associated += n
+    return associated
+
 def main():
     import argparse
     import lsst.daf.butler as dafButler
-    from lsst.daf.butler.registry import CollectionType, MissingCollectionError
 
     parser = argparse.ArgumentParser()
     parser.add_argument("repo")
@@ -15,6 +66,7 @@ def main():
     parser.add_argument("--datasets", "-d", nargs="+", required=True)
     parser.add_argument("--collections", nargs="+", default=[])
     parser.add_argument("--where")
+    parser.add_argument("--chunk-size", type=int, default=10000)
     parser.add_argument("--log-level", default="INFO")
 
     args = parser.parse_args()
@@ -24,23 +76,8 @@ def main():
     butler = dafButler.Butler(args.repo, writeable=True)
 
     tagged = os.path.normpath(f"{args.collection}")
-    
-    if args.collections:
-        collections = butler.registry.queryCollections(args.collections)
-    else:
-        collections = butler.registry.queryCollections("*")
-
-    butler.registry.registerCollection(tagged, CollectionType.TAGGED)
-    for dataset in args.datasets:
-        refs = list(set(list(butler.registry.queryDatasets(
-            dataset,
-            collections=collections,
-            where=args.where,
-            findFirst=True,
-        ))))
-
-        logger.info("associatating %s of %s into %s", len(refs), dataset, tagged)
-        butler.registry.associate(tagged, refs)
+    collections = resolve_collections(butler, args.collections)
+    associate(butler, tagged, args.datasets, collections, where=args.where, chunk_size=args.chunk_size)
 
 if __name__ == "__main__":
     main()
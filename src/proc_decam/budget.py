@@ -0,0 +1,176 @@
+"""
+A budget of cores and memory shared by every proc-decam process on a node
+
+Processes that start parallel work (pipetask, the bps site executors,
+ingest and the refcats downloads) lease cores and memory from the budget
+before starting and return them when done, so that nested and concurrent
+workflows never oversubscribe the node. Leases are kept in a JSON file
+guarded by an exclusive file lock; leases of processes that have exited are
+reclaimed automatically.
+
+The budget defaults to all cores and memory of the node, and can be set with
+the PROC_DECAM_CORES and PROC_DECAM_MEMORY (in GB) environment variables.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+def default_path():
+    return os.environ.get(
+        "PROC_DECAM_BUDGET",
+        os.path.join(os.path.expanduser("~"), ".proc-decam", f"budget-{socket.gethostname()}.json")
+    )
+
+def total_memory():
+    """
+    The memory of the node in GB
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) / 1024**2
+    except FileNotFoundError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class Lease():
+    def __init__(self, budget, id, cores, memory):
+        self.budget = budget
+        self.id = id
+        self.cores = cores
+        self.memory = memory
+
+    def release(self):
+        self.budget.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def __repr__(self):
+        return f"Lease(cores={self.cores}, memory={self.memory:.1f})"
+
+class Budget():
+    def __init__(self, path=None, cores=None, memory=None):
+        self.path = path or default_path()
+        self.cores = cores or int(os.environ.get("PROC_DECAM_CORES", os.cpu_count()))
+        self.memory = memory or float(os.environ.get("PROC_DECAM_MEMORY", total_memory()))
+        self._leases = {}
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        atexit.register(self._release_all)
+
+    def _update(self, func):
+        # read-modify-write the leases under an exclusive lock
+        with open(self.path + ".lock", "a+") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path) as f:
+                        leases = json.load(f)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    leases = {}
+                leases = {k: v for k, v in leases.items() if v['host'] != socket.gethostname() or _alive(v['pid'])}
+                result = func(leases)
+                with open(self.path + ".tmp", "w") as f:
+                    json.dump(leases, f)
+                os.replace(self.path + ".tmp", self.path)
+                return result
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _try_acquire(self, cores, memory, minimum):
+        def func(leases):
+            free_cores = self.cores - sum(v['cores'] for v in leases.values())
+            free_memory = self.memory - sum(v['memory'] for v in leases.values())
+            memory_per_core = memory / cores
+            granted = min(cores, free_cores)
+            if memory_per_core > 0:
+                granted = min(granted, int(free_memory // memory_per_core))
+            if granted < minimum:
+                return None
+            id = uuid.uuid4().hex
+            leases[id] = dict(
+                pid=os.getpid(),
+                host=socket.gethostname(),
+                cores=granted,
+                memory=granted * memory_per_core,
+                time=time.time(),
+            )
+            return Lease(self, id, granted, granted * memory_per_core)
+        return self._update(func)
+
+    def acquire(self, cores, memory=None, minimum=1, poll=5):
+        """
+        Lease up to ``cores`` cores and ``memory`` GB of memory, blocking until
+        at least ``minimum`` cores (and their share of the memory) are free
+
+        Memory defaults to the node's memory per core for each core. Requests
+        larger than the budget are reduced to the budget.
+        """
+        cores = max(1, min(int(cores), self.cores))
+        if memory is None:
+            memory = cores * self.memory / self.cores
+        memory = min(memory, self.memory)
+        minimum = max(1, min(minimum, cores))
+
+        waited = False
+        while True:
+            lease = self._try_acquire(cores, memory, minimum)
+            if lease is not None:
+                break
+            if not waited:
+                logger.info("waiting for %d cores and %.1f GB of memory from %s", minimum, memory * minimum / cores, self.path)
+                waited = True
+            time.sleep(poll)
+
+        logger.info("leased %d of %d requested cores and %.1f GB of memory", lease.cores, cores, lease.memory)
+        self._leases[lease.id] = lease
+        return lease
+
+    def release(self, lease):
+        if self._leases.pop(lease.id, None) is None:
+            return
+        self._update(lambda leases : leases.pop(lease.id, None))
+
+    def _release_all(self):
+        for lease in list(self._leases.values()):
+            self.release(lease)
+
+    def usage(self):
+        """
+        Return the cores and memory currently leased on this node
+        """
+        leases = self._update(lambda leases : dict(leases))
+        return sum(v['cores'] for v in leases.values()), sum(v['memory'] for v in leases.values())
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="proc-decam budget")
+    parser.add_argument("--path", default=None)
+
+    args = parser.parse_args()
+
+    budget = Budget(args.path)
+    cores, memory = budget.usage()
+    print(f"{budget.path}: {cores} of {budget.cores} cores and {memory:.1f} of {budget.memory:.1f} GB leased")
@@ -6,10 +6,12 @@ Associate those into {coadd_name}/warps
 Make a new chained collection {coadd_name} and execute.py on the input
 """
 import parsl
-from parsl import bash_app
 from parsl.executors import HighThroughputExecutor
+from .parsl import EpycProvider, KloneAstroProvider, KloneA40Provider
+from .workflow import StepGraph, thread_executor
+from .collection import CollectionChainManager, chain_command
+from .state import StateDB
 from functools import partial
-from .parsl import run_command, EpycProvider, KloneAstroProvider, KloneA40Provider
 from subprocess import Popen, PIPE
 import selectors
 import sys
@@ -59,6 +61,7 @@ pipeline_lookup = {
     "median": "median-template.yaml",
     "meanclip": "meanclip-template.yaml",
     "min": "min-template.yaml",
+    "multi": "multi-template.yaml",
     "": "template.yaml",
     None: "template.yaml",
 }
@@ -81,6 +84,13 @@ def main():
     parser.add_argument("--pipeline-slurm", action="store_true")
     parser.add_argument("--provider", default="EpycProvider")
     parser.add_argument("--workers", "-J", type=int, default=4)
+    parser.add_argument("--unified", action="store_true", help="run pipeline and execute steps as apps of this workflow")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="cores shared by all execute steps of a --unified workflow")
+    parser.add_argument("--critical-path", action="store_true", help="print the critical path of the workflow")
+    parser.add_argument("--state-db", default=os.path.join("runinfo", "state.db"), help="database recording the completed steps of workflows")
+    parser.add_argument("--no-resume", action="store_true", help="run all steps, even those that already completed")
+    parser.add_argument("--shard-by", default="tract", choices=["tract", "patch"], help="shard the per-patch steps by tract or by patch")
+    parser.add_argument("--shards", type=int, default=1, help="number of shards of each step to build and run concurrently")
     
     args = parser.parse_args()
 
@@ -101,7 +111,8 @@ def main():
             HighThroughputExecutor(
                 label=htex_label,
                 **executor_kwargs,
-            )
+            ),
+            thread_executor(),
         ],
         run_dir=os.path.join("runinfo", "coadd"),
     )
@@ -109,39 +120,24 @@ def main():
 
     inputs_collection = os.path.normpath(f"{args.coadd_subset}/{args.template_type}/coadd/inputs")
 
-    futures = [] # chage to dictionary
-    inputs = []
-    for dataset in [f"{args.warp_coadd_name}Coadd_directWarp", f"{args.warp_coadd_name}Coadd_psfMatchedWarp", "preSourceTable_visit", "finalized_src_table"]:
-    # associate dataset
-        cmd = [
-            "proc-decam",
-            "associate",
-            args.repo,
-            inputs_collection,
-            "--collections", f"{args.subset}/drp",
-            "--datasets", dataset
-        ]
-        cmd = " ".join(map(str, cmd))
-        func = partial(run_command)
-        setattr(func, "__name__", f"associate_{dataset}")
-        future = bash_app(func)(cmd, inputs=inputs)
-        futures.append(future)
-    
-    inputs = [f for f in futures]
+    graph = StepGraph()
+    # associate the datasets in one process, sharing a butler
     cmd = [
         "proc-decam",
-        "collection",
+        "associate",
         args.repo,
-        "coadd",
-        args.coadd_subset,
+        inputs_collection,
+        "--collections", f"{args.subset}/drp",
+        "--datasets", f"{args.warp_coadd_name}Coadd_directWarp", f"{args.warp_coadd_name}Coadd_psfMatchedWarp", "preSourceTable_visit", "finalized_src_table",
     ]
-    cmd += ["--template-type", args.template_type] if args.template_type else []
-    cmd = " ".join(map(str, cmd))
-    func = partial(run_command)
-    setattr(func, "__name__", f"collection")
-    future = bash_app(func)(cmd, inputs=inputs)
-    inputs = [future]
-    futures.append(future)
+    # steps reading the registry are never skipped, as more warps may have
+    # been made since the last run; everything downstream runs again too
+    associated = [graph.add("associate", cmd, memoize=False)]
+    
+    chains = CollectionChainManager(args.repo)
+    chain_cmd = chain_command(args.repo, "coadd", args.coadd_subset, template_type=args.template_type)
+    func = partial(chains.update, "coadd", args.coadd_subset, template_type=args.template_type)
+    deps = [graph.add("collection", chain_cmd, deps=associated, func=func, memoize=False)]
         
     # execute coadd
     # cmd = [
@@ -156,43 +152,66 @@ def main():
     # 
     # coadd pipeline
     steps = ["step3b", "step3c", "step3d"]
-    cmd = [
-        "proc-decam",
-        "pipeline",
-        args.repo,
-        "coadd",
-        args.coadd_subset,
-        "--steps", 
-    ] + steps
-    cmd += ["--template-type", args.template_type] if args.template_type else []
-    cmd += ["--slurm"] if args.pipeline_slurm else []
-    cmd += [f"--where \"{args.where}\""] if args.where else []
-        
+    if args.template_type == "multi":
+        # only the templates are assembled; detection and measurement read deepCoadd
+        steps = ["step3b"]
+    if args.unified or args.shards > 1:
+        # step3b and step3c are per patch, step3d is per tract
+        dimension = "tract,patch" if args.shard_by == "patch" else "tract"
+        shard_dimension = dict(step3b=dimension, step3c=dimension, step3d="tract")
+        from .pipeline import add_pipeline
+        deps = add_pipeline(
+            graph,
+            args.repo,
+            "coadd",
+            [os.path.normpath(f"{args.coadd_subset}/{args.template_type}/coadd")],
+            steps,
+            where=args.where,
+            template_type=args.template_type,
+            deps=deps,
+            executor="pipetask" if args.unified else "bps",
+            cores=max(1, args.cores // args.workers) if args.unified else None,
+            shard_dimension=shard_dimension,
+            shards=args.shards,
+            # only tracts and patches with warps, found with one query
+            shard_datasets=[f"{args.warp_coadd_name}Coadd_directWarp"],
+            chains=chains,
+        )
+    else:
+        cmd = [
+            "proc-decam",
+            "pipeline",
+            args.repo,
+            "coadd",
+            args.coadd_subset,
+            "--steps", 
+        ] + steps
+        cmd += ["--template-type", args.template_type] if args.template_type else []
+        cmd += ["--slurm"] if args.pipeline_slurm else []
+        cmd += [f"--where \"{args.where}\""] if args.where else []
+        deps = [graph.add("execute_coadd", cmd, deps=deps, cost=10 * len(steps), memoize=False)]
+
     # collection
-    cmd = " ".join(map(str, cmd))
-    func = partial(run_command)
-    setattr(func, "__name__", f"execute_coadd")
-    future = bash_app(func)(cmd, inputs=inputs)
-    inputs = [future]
-    futures.append(future)
+    done = graph.add("collection_done", chain_cmd, deps=deps, func=func, memoize=False)
+
+    if args.template_type == "multi":
+        # a coadd chain per statistic, for diff_drp with --template-type multi-<statistic>
+        from .tasks.multiStatisticCoadd import statistics
+        for statistic in statistics:
+            template_type = f"multi-{statistic}"
+            graph.add(
+                f"collection_{template_type}",
+                chain_command(args.repo, "coadd", args.coadd_subset, template_type=template_type, input_type="multi_coadd"),
+                deps=[done],
+                func=partial(chains.update, "coadd", args.coadd_subset, template_type=template_type, input_type="multi_coadd"),
+                memoize=False,
+            )
 
-    cmd = [
-        "proc-decam",
-        "collection",
-        args.repo,
-        "coadd",
-        args.coadd_subset,
-    ]
-    cmd += ["--template-type", args.template_type] if args.template_type else []
-        
-    cmd = " ".join(map(str, cmd))
-    func = partial(run_command)
-    setattr(func, "__name__", f"collection")
-    future = bash_app(func)(cmd, inputs=inputs)
-    inputs = [future]
-    futures.append(future)
-
-    for future in futures:
+    if args.critical_path:
+        graph.print_critical_path()
+
+    futures = graph.submit(state=StateDB(args.state_db), resume=not args.no_resume)
+    for future in futures.values():
         if future:
             future.exception()
     
@@ -1,4 +1,8 @@
 import logging
+import os
+import re
+import threading
+from datetime import datetime
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -43,19 +47,125 @@ inputs = dict(
     diff_drp=[
         "{coadd_subset}/{template_type}/coadd", # coadds CHAINED
         "{subset}/drp", # calexp CHAINED
-    ]
+    ],
+    # one statistic of a multi-statistic coadd, e.g. {subset}/multi-median/coadd
+    multi_coadd=[
+        "{subset}/multi/coadd",
+    ],
 )
 
+date_regex = re.compile(r"\d{8}T\d{6}Z")
+
+def chain_parent(proc_type, subset, coadd_subset="", template_type=""):
+    return os.path.normpath(f"{subset}/{coadd_subset}/{template_type}/{proc_type}")
+
+def chain_command(repo, proc_type, subset, coadd_subset="", template_type="", input_type=None):
+    """
+    The proc-decam collection command equivalent to CollectionChainManager.update
+    """
+    cmd = ["proc-decam", "collection", repo, proc_type, subset]
+    cmd += ["--coadd-subset", coadd_subset] if coadd_subset else []
+    cmd += ["--template-type", template_type] if template_type else []
+    cmd += ["--input-type", input_type] if input_type else []
+    return cmd
+
+class CollectionChainManager():
+    """
+    Sets the chain of a proc type's CHAINED collection to its runs, newest
+    first, followed by its input collections
+
+    Input collections are resolved together with one pattern query and those
+    found are cached, so a workflow can share one manager between all of its
+    collection steps. Chain updates are serialized and each is applied in a
+    transaction.
+    """
+    def __init__(self, repo, butler=None):
+        self.repo = repo
+        self._butler = butler
+        self._existing = set()
+        self._lock = threading.Lock()
+
+    @property
+    def butler(self):
+        if self._butler is None:
+            import lsst.daf.butler as dafButler
+            self._butler = dafButler.Butler(self.repo, writeable=True)
+        return self._butler
+
+    def existing(self, candidates):
+        """
+        Return the collections of ``candidates`` that exist, in order
+        """
+        unknown = [c for c in candidates if c not in self._existing]
+        if unknown:
+            # collections that do not exist yet may be created by other steps, so only hits are cached
+            pattern = re.compile("|".join(map(re.escape, unknown)))
+            self._existing.update(self.butler.registry.queryCollections(pattern))
+        return [c for c in candidates if c in self._existing]
+
+    def runs(self, parent):
+        from lsst.daf.butler.registry import CollectionType
+        from .compact import compacted_runs
+
+        runs = self.butler.registry.queryCollections(parent + "/*", collectionTypes=CollectionType.RUN)
+        # runs merged by proc-decam compact are replaced by their compacted collection
+        merged = compacted_runs(self.butler, parent)
+        runs = [run for run in runs if run not in merged]
+        compacted = sorted(self.butler.registry.queryCollections(re.compile(re.escape(parent) + "/.*/compacted$"), collectionTypes=CollectionType.TAGGED))
+
+        date_runs = []
+        non_date_runs = []
+        for run in runs:
+            if date_regex.match(run.split("/")[-1]) is not None:
+                date_runs.append(run)
+            else:
+                non_date_runs.append(run)
+        return sorted(date_runs, key=lambda x : datetime.fromisoformat(x.split("/")[-1]), reverse=True) + compacted + sorted(non_date_runs)
+
+    def chain(self, proc_type, subset, coadd_subset="", template_type="", input_type=None):
+        parent = chain_parent(proc_type, subset, coadd_subset=coadd_subset, template_type=template_type)
+        input_collections = list(map(lambda x : os.path.normpath(x.format(subset=subset, template_type=template_type, coadd_subset=coadd_subset)), inputs[input_type or proc_type]))
+        found = self.existing(input_collections)
+        for child in input_collections:
+            if child not in found:
+                logger.warning("%s missing child %s", parent, child)
+        return parent, self.runs(parent) + found
+
+    def update(self, proc_type, subset, coadd_subset="", template_type="", overwrite=False, input_type=None):
+        """
+        Create or update the chain of a proc type's collection
+
+        The inputs of ``input_type`` are used in place of those of
+        ``proc_type`` if given. A chain that would lose children is only
+        replaced with ``overwrite``. Returns the chain.
+        """
+        from lsst.daf.butler.registry import CollectionType
+
+        with self._lock:
+            parent, chain = self.chain(proc_type, subset, coadd_subset=coadd_subset, template_type=template_type, input_type=input_type)
+            logger.info("setting %s to chain %s", parent, chain)
+            # collections cannot be registered inside a transaction
+            self.butler.registry.registerCollection(parent, CollectionType.CHAINED)
+            with self.butler.transaction():
+                existing = self.butler.registry.getCollectionChain(parent)
+                missing = set(existing).difference(set(chain))
+                new = set(chain).difference(set(existing))
+                if missing:
+                    logger.warning("missing children %s", missing)
+                    if not overwrite:
+                        return list(existing)
+                    logger.info("overwriting existing chain")
+                elif new:
+                    logger.info("adding new children %s", new)
+                self.butler.registry.setCollectionChain(parent, chain)
+            self._existing.add(parent)
+            return chain
+
 def main():
     """
-    
+    Update the chain of a proc type's collection
     """
     import argparse
-    import lsst.daf.butler as dafButler
-    from lsst.daf.butler.registry import CollectionType, MissingCollectionError
-    from datetime import datetime
-    import os
-    import re
 
     parser = argparse.ArgumentParser()
     parser.add_argument("repo")
@@ -65,53 +175,20 @@ def main():
     parser.add_argument("--template-type", default="")
     parser.add_argument("--log-level", default="INFO")
     parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--input-type", default=None, choices=list(inputs.keys()), help="use the inputs of another proc type")
 
     args = parser.parse_args()
     
     logging.getLogger().setLevel(args.log_level)
 
-    butler = dafButler.Butler(args.repo, writeable=True)
-
-    parent = os.path.normpath(f"{args.subset}/{args.coadd_subset}/{args.template_type}/{args.proc_type}")
-    
-    input_collections = list(map(lambda x : os.path.normpath(x.format(subset=args.subset, template_type=args.template_type, coadd_subset=args.coadd_subset)), inputs[args.proc_type]))
-    input_runs = butler.registry.queryCollections(parent + "/*", collectionTypes=CollectionType.RUN)
-    
-    date_runs = []
-    non_date_runs = []
-    for run in input_runs:
-        if re.compile("\d{8}T\d{6}Z").match(run.split("/")[-1]) is not None:
-            date_runs.append(run)
-        else:
-            non_date_runs.append(run)
-    input_runs = sorted(date_runs, key=lambda x : datetime.fromisoformat(x.split("/")[-1]), reverse=True) + sorted(non_date_runs)
-
-    chain = []
-    for child in input_runs + input_collections:
-        try:
-            butler.registry.queryCollections(child)
-            chain.append(child)
-        except MissingCollectionError:
-            logger.warning("%s missing child %s", parent, child)
-            pass
-
-    logger.info("setting %s to chain %s", parent, chain)
-    try:
-        existing = butler.registry.getCollectionChain(parent)
-        missing = set(existing).difference(set(chain))
-        new = set(chain).difference(set(existing))
-        if missing:
-            logger.warning("missing children %s", missing)
-            if args.overwrite:
-                logger.info("overwriting existing chain")
-                butler.registry.setCollectionChain(parent, chain)
-        else:
-            if new:
-                logger.info("adding new children %s", new)
-            butler.registry.setCollectionChain(parent, chain)
-    except MissingCollectionError:
-        butler.registry.registerCollection(parent, CollectionType.CHAINED)
-        butler.registry.setCollectionChain(parent, chain)
+    CollectionChainManager(args.repo).update(
+        args.proc_type,
+        args.subset,
+        coadd_subset=args.coadd_subset,
+        template_type=args.template_type,
+        overwrite=args.overwrite,
+        input_type=args.input_type,
+    )
 
 if __name__ == "__main__":
     main()
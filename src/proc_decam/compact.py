@@ -0,0 +1,134 @@
+"""
+Compact the dated runs of a CHAINED collection
+
+Every submission by `proc-decam execute` adds a dated RUN collection
+{parent}/{pipeline}/{step}/{YYYYMMDDTHHMMSSZ} to the parent chain. Compaction
+replaces the older runs of each step in the chain with a single TAGGED
+collection {parent}/{pipeline}/{step}/compacted holding the datasets a
+find-first search through those runs would return. The runs that were merged
+are listed in the documentation of the compacted collection, and runs without
+any datasets are removed.
+"""
+import logging
+import re
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+date_regex = re.compile(r".*/(?P<date>\d{8}T\d{6}Z)$")
+compacted_prefix = "compacted runs: "
+
+def compacted_collection(step):
+    return f"{step}/compacted"
+
+def compacted_runs(butler, parent):
+    """
+    Return the runs of ``parent`` merged into a compacted collection
+    """
+    from lsst.daf.butler.registry import CollectionType
+
+    runs = set()
+    for tagged in butler.registry.queryCollections(re.compile(re.escape(parent) + "/.*/compacted$"), collectionTypes=CollectionType.TAGGED):
+        doc = butler.registry.getCollectionDocumentation(tagged) or ""
+        if doc.startswith(compacted_prefix):
+            runs.update(r for r in doc[len(compacted_prefix):].split(",") if r)
+    return runs
+
+def _is_empty(butler, run):
+    for _ in butler.registry.queryDatasets(..., collections=run):
+        return False
+    return True
+
+def _merge(butler, tagged, runs):
+    # the datasets found first searching the runs (newest first) and then the
+    # existing compacted collection replace what it held before
+    collections = list(runs) + [tagged]
+    dataset_types = set()
+    for dataset_type in butler.registry.queryDatasetTypes(...):
+        for _ in butler.registry.queryDatasets(dataset_type, collections=runs):
+            dataset_types.add(dataset_type)
+            break
+
+    associated = 0
+    for dataset_type in dataset_types:
+        refs = set(butler.registry.queryDatasets(dataset_type, collections=collections, findFirst=True))
+        existing = set(butler.registry.queryDatasets(dataset_type, collections=tagged))
+        if existing - refs:
+            butler.registry.disassociate(tagged, list(existing - refs))
+        if refs - existing:
+            butler.registry.associate(tagged, list(refs - existing))
+            associated += len(refs - existing)
+    return associated
+
+def compact(butler, parent, keep=1):
+    """
+    Merge all but the newest ``keep`` dated runs of each step of the CHAINED
+    collection ``parent`` into a compacted collection per step and rewrite
+    the chain to use it
+
+    Returns the number of runs compacted.
+    """
+    from lsst.daf.butler.registry import CollectionType
+
+    chain = list(butler.registry.getCollectionChain(parent))
+    steps = {}
+    for child in chain:
+        if child.startswith(parent + "/") and date_regex.match(child):
+            steps.setdefault(child.rsplit("/", 1)[0], []).append(child)
+
+    compacted = 0
+    for step, runs in steps.items():
+        runs = sorted(runs, key=lambda x : date_regex.match(x).group("date"), reverse=True)
+        old = runs[keep:]
+        if not old:
+            continue
+
+        tagged = compacted_collection(step)
+        # collections cannot be registered inside a transaction
+        butler.registry.registerCollection(tagged, CollectionType.TAGGED)
+        with butler.transaction():
+            doc = butler.registry.getCollectionDocumentation(tagged) or ""
+            merged = set(doc[len(compacted_prefix):].split(",")) - {""} if doc.startswith(compacted_prefix) else set()
+
+            empty = [run for run in old if _is_empty(butler, run)]
+            nonempty = [run for run in old if run not in empty]
+            n = _merge(butler, tagged, nonempty) if nonempty else 0
+            logger.info("compacted %d runs of %s into %s with %d new datasets", len(old), step, tagged, n)
+
+            merged.update(nonempty)
+            butler.registry.setCollectionDocumentation(tagged, compacted_prefix + ",".join(sorted(merged)))
+
+            # the compacted collection takes the place of the newest run it replaces
+            position = chain.index(old[0])
+            chain = [c for c in chain if c not in old and c != tagged]
+            chain.insert(min(position, len(chain)), tagged)
+            butler.registry.setCollectionChain(parent, chain)
+
+        for run in empty:
+            logger.info("removing empty run %s", run)
+            butler.registry.removeCollection(run)
+        compacted += len(old)
+
+    return compacted
+
+def main():
+    import argparse
+    import lsst.daf.butler as dafButler
+
+    parser = argparse.ArgumentParser(prog="proc-decam compact")
+    parser.add_argument("repo")
+    parser.add_argument("parents", nargs="+")
+    parser.add_argument("--keep", type=int, default=1, help="newest runs of each step to leave in the chain")
+    parser.add_argument("--log-level", default="INFO")
+
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level)
+
+    butler = dafButler.Butler(args.repo, writeable=True)
+    for parent in args.parents:
+        n = compact(butler, parent, keep=args.keep)
+        logger.info("compacted %d runs of %s", n, parent)
+
+if __name__ == "__main__":
+    main()
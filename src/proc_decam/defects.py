@@ -9,22 +9,49 @@ logger.setLevel(logging.INFO)
 BADPIX_VALUE = 1
 SUSPECTPIX_VALUE = 7
 
-def download_data(download_dir):
-    REMOTE_URL = "https://epyc.astro.washington.edu/~stevengs/decam_bpm"
+REMOTE_URL = "https://epyc.astro.washington.edu/~stevengs/decam_bpm"
+
+def download_file(url, path, chunk_size=1024**2):
+    """
+    Download ``url`` to ``path``, resuming a partial download left in
+    ``path``.part by an earlier attempt
+    """
+    if os.path.exists(path):
+        logger.info("skipping existing file %s", path)
+        return path
+    part = path + ".part"
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with requests.get(url, headers=headers, stream=True, timeout=60) as r:
+        if r.status_code == 416:
+            # the partial download is already complete
+            pass
+        else:
+            r.raise_for_status()
+            if offset and r.status_code != 206:
+                # the server ignored the range, so start over
+                offset = 0
+            logger.info("downloading %s%s", url, f" from byte {offset}" if offset else "")
+            with open(part, "ab" if offset else "wb") as fp:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    fp.write(chunk)
+    os.replace(part, path)
+    return path
+
+def download_data(download_dir, workers=8):
+    import joblib
+
+    jobs = []
     for d in ['cp', 'des']:
-        r = requests.get(f"{REMOTE_URL}/{d}/index.dat")
+        r = requests.get(f"{REMOTE_URL}/{d}/index.dat", timeout=60)
         r.raise_for_status()
         files = r.text.strip().split("\n")
+        os.makedirs(os.path.join(download_dir, d), exist_ok=True)
         for f in files:
-            if os.path.exists(os.path.join(download_dir, d, f)):
-                logger.info("skipping existing file %s", f)
-                continue
-            os.makedirs(os.path.join(download_dir, d), exist_ok=True)
-            logger.info("downloading %s", f)
-            r2 = requests.get(f"{REMOTE_URL}/{d}/{f}")
-            r2.raise_for_status()
-            with open(os.path.join(download_dir, d, f), "wb") as fp:
-                fp.write(r2.content)
+            jobs.append((f"{REMOTE_URL}/{d}/{f}", os.path.join(download_dir, d, f)))
+
+    with joblib.parallel_config(backend="threading", n_jobs=workers):
+        joblib.Parallel()(joblib.delayed(download_file)(url, path) for url, path in jobs)
 
 def load_des(path, detector):
     import os
@@ -32,10 +59,10 @@ def load_des(path, detector):
     p = os.path.join(path, "des", f"D_n20150105t0115_c{detector:02d}_r2134p01_bpm.fits")
     logger.info("loading %s", p)
     if os.path.exists(p):
-        des = fits_io.open(p)
-        assert(des[0].header['CCDNUM'] == detector)
-        bad = ((des[0].data != 512) & (des[0].data != 0)).astype(int) * BADPIX_VALUE
-        suspect = (des[0].data == 512).astype(int) * SUSPECTPIX_VALUE
+        with fits_io.open(p, memmap=True) as des:
+            assert(des[0].header['CCDNUM'] == detector)
+            bad = ((des[0].data != 512) & (des[0].data != 0)).astype(int) * BADPIX_VALUE
+            suspect = (des[0].data == 512).astype(int) * SUSPECTPIX_VALUE
         return bad, suspect
     return None, None
 
@@ -45,56 +72,126 @@ def load_cp(path, detector):
     p = os.path.join(path, "cp", f"DECam_Master_20140209v2_cd_{detector:02d}.fits")
     logger.info("loading %s", p)
     if os.path.exists(p):
-        cp = fits_io.open(p)
-        assert(cp[0].header['CCDNUM'] == detector)
-        bad = (cp[0].data != 0).astype(int)
+        with fits_io.open(p, memmap=True) as cp:
+            assert(cp[0].header['CCDNUM'] == detector)
+            bad = (cp[0].data != 0).astype(int)
         return bad, None
     return None, None
 
-def create_defects(defects, bad, suspect):
+def mask_to_boxes(mask):
+    """
+    Decompose a mask into disjoint boxes covering exactly its set pixels
+
+    Each column is split into runs of set pixels, and runs with the same
+    rows in adjacent columns are merged into one box, so bad columns and
+    blocks become a handful of boxes rather than one per pixel. Returns
+    arrays of x0, y0, width and height.
+    """
     import numpy as np
+
+    mask = np.asarray(mask).astype(bool)
+    # runs along y within each column (x), found from the edges of the padded mask
+    padded = np.zeros((mask.shape[1], mask.shape[0] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask.T
+    edges = np.diff(padded, axis=1)
+    x, y0 = np.nonzero(edges == 1)
+    _, y1 = np.nonzero(edges == -1)
+    height = y1 - y0
+    if len(x) == 0:
+        empty = np.zeros(0, dtype=int)
+        return empty, empty, empty, empty
+
+    # merge runs spanning the same rows of consecutive columns
+    order = np.lexsort((x, height, y0))
+    x, y0, height = x[order], y0[order], height[order]
+    new = np.ones(len(x), dtype=bool)
+    new[1:] = (y0[1:] != y0[:-1]) | (height[1:] != height[:-1]) | (x[1:] != x[:-1] + 1)
+    starts = np.flatnonzero(new)
+    width = np.diff(np.append(starts, len(x)))
+    return x[starts], y0[starts], width, height[starts]
+
+def boxes_to_mask(shape, boxes):
+    import numpy as np
+
+    mask = np.zeros(shape, dtype=bool)
+    for x0, y0, width, height in zip(*boxes):
+        mask[y0:y0 + height, x0:x0 + width] = True
+    return mask
+
+def boxes_to_defects(boxes, metadata):
     import astropy.table
     from lsst.ip.isr.defects import Defects
 
+    x0, y0, width, height = boxes
+    if len(x0) == 0:
+        d = Defects()
+    else:
+        d = Defects.fromTable([astropy.table.Table(dict(x0=x0, y0=y0, width=width, height=height))])
+    d.setMetadata(metadata)
+    return d
+
+def create_defects(defects, bad, suspect):
+    from lsst.ip.isr.defects import Defects
+
     pl = defects.toDict()['metadata'].deepCopy()
     if bad is not None:
-        d = []
-        for x, y in zip(*np.where(bad)):
-            d.append({
-                "x0": y,
-                "y0": x,
-                "width": 1,
-                "height": 1,
-            })
-
-        d = astropy.table.Table(d)
-        d = Defects.fromTable([d])
-        d.setMetadata(pl)
+        d = boxes_to_defects(mask_to_boxes(bad), pl)
     else:
         d = defects
 
     pl = defects.toDict()['metadata'].deepCopy()
     if suspect is not None:
         pl['DEFECTTYPE'] = "SUSPECTPIXEL"
-        s = []
-        for x, y in zip(*np.where(suspect)):
-            s.append({
-                "x0": y,
-                "y0": x,
-                "width": 1,
-                "height": 1,
-            })
-
-        s = astropy.table.Table(s)
-        s = Defects.fromTable([s])
-        s.setMetadata(pl)
+        s = boxes_to_defects(mask_to_boxes(suspect), pl)
     else:
         s = Defects()
         s.setMetadata(pl)
     return d, s
 
+def load_bad(path, detector):
+    bad_des, suspect_des = load_des(path, detector)
+    bad_cp, _ = load_cp(path, detector)
+    if bad_des is not None and bad_cp is not None:
+        bad = ((bad_des == BADPIX_VALUE) | (bad_cp == BADPIX_VALUE)).astype(int) * BADPIX_VALUE
+    elif bad_des is not None:
+        bad = bad_des
+    elif bad_cp is not None:
+        bad = bad_cp
+    else:
+        bad = None
+    return bad, suspect_des
+
+def benchmark(path, detectors):
+    """
+    Check that the boxes of each detector's masks reproduce the masks, and
+    compare their number and the time to find them with one box per pixel
+    """
+    import time
+    import numpy as np
+
+    ok = True
+    for detector in detectors:
+        bad, suspect = load_bad(path, detector)
+        for name, mask in [("bad", bad), ("suspect", suspect)]:
+            if mask is None:
+                continue
+            t0 = time.perf_counter()
+            pixels = len(np.nonzero(mask)[0])
+            t1 = time.perf_counter()
+            boxes = mask_to_boxes(mask)
+            t2 = time.perf_counter()
+            same = np.array_equal(boxes_to_mask(mask.shape, boxes), mask.astype(bool))
+            ok &= same
+            print(
+                f"detector {detector:02d} {name}: {pixels} pixels ({1e3 * (t1 - t0):.1f} ms) -> "
+                f"{len(boxes[0])} boxes ({1e3 * (t2 - t1):.1f} ms), "
+                f"{pixels / max(len(boxes[0]), 1):.0f}x fewer, round trip {'ok' if same else 'FAILED'}"
+            )
+    return ok
+
 def main():
     import argparse
+    import joblib
     import lsst.daf.butler as dafButler
     import astropy.time
     from datetime import datetime
@@ -107,9 +204,20 @@ def main():
     parser.add_argument("--bad-dataset", default="defects")
     parser.add_argument("--suspect-dataset", default="suspectMask")
     parser.add_argument("--run-prefix", default="DECam/calib_bpm")
+    parser.add_argument("--processes", "-J", type=int, default=8)
+    parser.add_argument("--download", action="store_true", help="download the bad pixel masks to bpm_path first, resuming partial downloads")
+    parser.add_argument("--benchmark", action="store_true", help="check and time the defect boxes of each detector without writing them")
 
     args = parser.parse_args()
 
+    if args.download:
+        download_data(args.bpm_path, workers=args.processes)
+
+    if args.benchmark:
+        if not benchmark(args.bpm_path, range(1, 63)):
+            raise RuntimeError("defect boxes do not reproduce the masks")
+        return
+
     butler = dafButler.Butler(args.repo, writeable=True)
 
     def register_collection_if_not_exists(collection, collection_type):
@@ -159,42 +267,36 @@ def main():
         purge=True,
     )
 
-    for detector in range(1, 63):
-        ref = list(sorted(
-            butler.registry.queryDatasets(
-                "defects", 
-                instrument='DECam', 
-                detector=detector, 
-                collections="DECam/calib"
-            ),
-            key=lambda x : datetime.fromisoformat(x.run.split("/")[-1])
-        ))[-1]
+    # the latest defects of every detector, from one query
+    latest = {}
+    for ref in butler.registry.queryDatasets("defects", instrument='DECam', collections="DECam/calib"):
+        detector = ref.dataId["detector"]
+        date = datetime.fromisoformat(ref.run.split("/")[-1])
+        if detector not in latest or date > latest[detector][0]:
+            latest[detector] = (date, ref)
+
+    def job(detector):
+        ref = latest[detector][1]
         logger.info("loading %s", ref)
         defects = butler.get(ref)
-        bad_des, suspect_des = load_des(args.bpm_path, detector)
-        bad_cp, _ = load_cp(args.bpm_path, detector)
-        if bad_des is not None and bad_cp is not None:
-            bad = ((bad_des == BADPIX_VALUE) | (bad_cp == BADPIX_VALUE)).astype(int) * BADPIX_VALUE
-        elif bad_des is not None:
-            bad = bad_des
-        elif bad_cp is not None:
-            bad = bad_cp
-        else:
-            bad = None
-
-        bad_defects, suspect_defects = create_defects(defects, bad, suspect_des)
-        logger.info("putting %s in %s for detector %d", args.bad_dataset, bad_run, detector)
-        butler.put(
-            bad_defects, args.bad_dataset, 
-            dataId={"instrument": "DECam", "detector": detector},
-            run=bad_run,
-        )
-        logger.info("putting %s in %s for detector %d", args.suspect_dataset, suspect_run, detector)
-        butler.put(
-            suspect_defects, args.suspect_dataset, 
-            dataId={"instrument": "DECam", "detector": detector},
-            run=suspect_run,
-        )
+        bad, suspect_des = load_bad(args.bpm_path, detector)
+        return detector, create_defects(defects, bad, suspect_des)
+
+    detectors = [detector for detector in range(1, 63) if detector in latest]
+    for detector in sorted(set(range(1, 63)) - set(detectors)):
+        logger.warning("no defects in DECam/calib for detector %d", detector)
+
+    # the FITS reads and defect construction of each detector run in threads,
+    # and everything is put together at the end
+    with joblib.parallel_config(backend="threading", n_jobs=args.processes):
+        results = joblib.Parallel()(joblib.delayed(job)(detector) for detector in detectors)
+
+    logger.info("putting %s in %s and %s in %s for %d detectors", args.bad_dataset, bad_run, args.suspect_dataset, suspect_run, len(results))
+    with butler.transaction():
+        for detector, (bad_defects, suspect_defects) in results:
+            dataId = {"instrument": "DECam", "detector": detector}
+            butler.put(bad_defects, args.bad_dataset, dataId=dataId, run=bad_run)
+            butler.put(suspect_defects, args.suspect_dataset, dataId=dataId, run=suspect_run)
 
     timespan = dafButler.Timespan(
         astropy.time.Time("1970-01-01T00:00:00", scale='tai'),
@@ -12,6 +12,10 @@ from subprocess import Popen, PIPE
 import selectors
 import sys
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .budget import Budget
+from .compact import compact, compacted_runs
 
 if not os.path.exists(os.path.join(os.getcwd(), "pipelines")):
     raise RuntimeError("Cannot find directory 'pipelines' in the current working directory")
@@ -58,15 +62,31 @@ run_date_format = "%Y%m%dT%H%M%SZ"
 def generate_date():
     return datetime.now().strftime(run_date_format)
 
+# chains with more dated runs than this are compacted
+compact_threshold = int(os.environ.get("PROC_DECAM_COMPACT_THRESHOLD", 20))
+
+# shards of a step share the parent chain
+_chain_lock = threading.Lock()
+
 def fixup_chain(repo, collection):
+    with _chain_lock:
+        _fixup_chain(repo, collection)
+
+def _fixup_chain(repo, collection):
     butler = dafButler.Butler(repo, writeable=True)
     runs = butler.registry.queryCollections(re.compile(collection + "/.*/\d{8}T\d{6}Z$"), collectionTypes=CollectionType.RUN)
+    # runs merged into a compacted collection are found through it
+    merged = compacted_runs(butler, collection)
+    runs = [run for run in runs if run not in merged]
     existing_children = butler.registry.getCollectionChain(collection)
     other_children = [c for c in existing_children if c not in runs]
     runs = sorted(runs, key=lambda x : datetime.fromisoformat(re.compile(".*/(?P<date>\d{8}T\d{6}Z)$").match(x).groupdict()['date']), reverse=True)
     children = runs + other_children
     print("setting", collection, "=", children, file=sys.stderr)
     butler.registry.setCollectionChain(collection, children)
+    if len(runs) > compact_threshold:
+        print("compacting", len(runs), "runs of", collection, file=sys.stderr)
+        compact(butler, collection)
 
 def normalize_pipeline(pipeline_path):
     filename = os.path.basename(pipeline_path)
@@ -78,18 +98,126 @@ def normalize_pipeline(pipeline_path):
     return pipeline_name, pipeline_step
 
 
-def construct_run(parent, pipeline_path):
+def construct_run(parent, pipeline_path, shard=None):
     pipeline_name, pipeline_step = normalize_pipeline(pipeline_path)
+    if shard:
+        pipeline_step = f"{pipeline_step}-{shard}"
     run = f"{parent}/{pipeline_name}/{pipeline_step}/{generate_date()}"
     return run
 
-def should_run(repo, collection, pipeline, data_query=None, skip_existing=True, skip_failures=True):
+def _literal(value):
+    return str(value) if isinstance(value, int) else f"'{value}'"
+
+def _constraint(dimensions, block):
+    """
+    A where clause selecting exactly the data ID values in ``block``
+    """
+    *outer, inner = dimensions
+    if not outer:
+        if isinstance(block[0][0], int):
+            # contiguous blocks of integer values are ranges
+            return f"{inner} >= {block[0][0]} AND {inner} <= {block[-1][0]}"
+        return f"{inner} IN (" + ", ".join(_literal(v[0]) for v in block) + ")"
+    groups = {}
+    for values in block:
+        groups.setdefault(values[:-1], []).append(values[-1])
+    clauses = []
+    for key, values in groups.items():
+        clause = " AND ".join(f"{d} = {_literal(v)}" for d, v in zip(outer, key))
+        clauses.append(f"({clause} AND {inner} IN (" + ", ".join(_literal(v) for v in values) + "))")
+    return " OR ".join(clauses)
+
+def input_dataset_types(butler, pipeline_path, dimensions, repo=None, config=()):
+    """
+    The input dataset types of a pipeline (other than prerequisites, such as
+    calibrations) that have all of ``dimensions``
+    """
+    from .qgraph import load_pipeline_graph
+
+    pipeline_graph = load_pipeline_graph(pipeline_path, butler, repo=repo, config=config)
+    names = []
+    for name, node in pipeline_graph.iter_overall_inputs():
+        if node is None or node.is_prerequisite:
+            continue
+        if set(dimensions).issubset(node.dimensions.names):
+            names.append(name)
+    return names
+
+def shard_queries(repo, data_query, dimension, shards, datasets=None, collections=None, pipeline_path=None, config=()):
+    """
+    Split a data query into at most ``shards`` queries over contiguous blocks
+    of the values of ``dimension``, e.g. detector ranges or blocks of visits
+
+    ``dimension`` may be a comma separated list, e.g. "tract,patch", to shard
+    over combinations of values. Only the values with any of ``datasets`` in
+    ``collections`` are used, found with a query per dataset type;
+    ``datasets`` defaults to the inputs of the pipeline at ``pipeline_path``
+    with those dimensions. Returns a list of (shard name, query) pairs.
+    """
+    dimensions = dimension.split(",")
+    # tracts and patches are only unique within a skymap
+    query_dimensions = list(dimensions)
+    if "skymap" not in dimensions and {"tract", "patch"} & set(dimensions):
+        query_dimensions = ["skymap"] + query_dimensions
+
+    butler = dafButler.Butler(repo)
+    if not datasets and pipeline_path and collections:
+        datasets = input_dataset_types(butler, pipeline_path, dimensions, repo=repo, config=config)
+        print("sharding over the data IDs of", datasets, file=sys.stderr)
+
+    if datasets:
+        queries = [dict(datasets=dataset, collections=collections) for dataset in datasets]
+    else:
+        queries = [{}]
+    values = set()
+    for kwargs in queries:
+        values.update(
+            tuple(data_id[d] for d in query_dimensions)
+            for data_id in butler.registry.queryDataIds(query_dimensions, where=data_query or "", **kwargs)
+        )
+    values = sorted(values)
+    if not values:
+        return []
+    shards = min(shards, len(values))
+    size, extra = divmod(len(values), shards)
+    queries = []
+    start = 0
+    for i in range(shards):
+        block = values[start:start + size + (1 if i < extra else 0)]
+        start += len(block)
+        constraint = _constraint(query_dimensions, block)
+        query = f"({data_query}) AND ({constraint})" if data_query else constraint
+        queries.append((f"{'-'.join(dimensions)}{i}", query))
+    return queries
+
+def qgraph_path(run, attempt=0):
+    suffix = f".{attempt}.qgraph" if attempt else ".qgraph"
+    return os.path.join(os.environ.get('TMPDIR', "/tmp"), run.replace("/", "_") + suffix)
+
+def bps_config_path(run):
+    return os.path.join(os.environ.get('TMPDIR', "/tmp"), run.replace("/", "_") + ".yaml")
+
+def should_run(repo, collection, pipeline, data_query=None, skip_existing=True, skip_failures=True, output_run="dummy", save_qgraph=None, probe=False, bps_config=None, config=()):
+    """
+    Build the quantum graph of the pipeline, returning whether it has any quanta
+
+    With ``save_qgraph`` the graph is saved with datastore records for the
+    quantum-backed butler, so it can be submitted directly. With ``probe`` the
+    registry is only checked for pending quanta instead of building a graph.
+    With ``bps_config`` a bps config requesting the memory each task used in
+    prior runs is written alongside.
+    """
+    if skip_existing and not probe:
+        # avoid building a graph when nothing is left to run
+        if not should_run(repo, collection, pipeline, data_query=data_query, skip_existing=skip_existing, skip_failures=skip_failures, probe=True, config=config):
+            return False
+
     cmd = [
         "proc-decam",
         "qgraph",
         "-b", repo,
         "-i", collection,
-        "--output-run", "dummy",
+        "--output-run", output_run,
         "-p", pipeline,
     ]
     if data_query:
@@ -98,6 +226,14 @@ def should_run(repo, collection, pipeline, data_query=None, skip_existing=True,
         cmd += ["--skip-existing-in", collection]
     if skip_failures:
         cmd += ["--skip-failures"]
+    if save_qgraph:
+        cmd += ["--save-qgraph", save_qgraph, "--qgraph-datastore-records"]
+    if probe:
+        cmd += ["--probe"]
+    if bps_config:
+        cmd += ["--bps-config", bps_config]
+    for c in config:
+        cmd += ["-c", c]
 
     p = popen(cmd, stdout=PIPE, stderr=PIPE)
     stdout, stderr = p.communicate()
@@ -111,49 +247,119 @@ def should_run(repo, collection, pipeline, data_query=None, skip_existing=True,
     return True
 
 
-def submit(repo, parent, pipeline_path, data_query=None, skip_existing=True, skip_failures=True, trigger_retry=False, loop=False):
+def prune(repo, qgraph_file, pruned_qgraph_file, skip_failures=True, bps_config=None):
+    """
+    Save the quanta of a submitted graph that still have to run to a new
+    graph, returning whether there are any
+    """
+    cmd = [
+        "proc-decam",
+        "qgraph",
+        "-b", repo,
+        "--prune-qgraph", qgraph_file,
+        "--save-qgraph", pruned_qgraph_file,
+    ]
+    if skip_failures:
+        cmd += ["--skip-failures"]
+    if bps_config:
+        cmd += ["--bps-config", bps_config]
+
+    p = popen(cmd, stdout=PIPE, stderr=PIPE)
+    stdout, stderr = p.communicate()
+    print(stdout.decode())
+    p.wait()
+    if p.returncode != 0:
+        for line in stderr.decode().split("\n"):
+            if "quantum graph is empty" in line:
+                return False
+        raise RuntimeError("prune failure: " + stderr.decode())
+    return True
+
+def submit(repo, parent, pipeline_path, data_query=None, skip_existing=True, skip_failures=True, trigger_retry=False, loop=False, executor="bps", cores=None, incremental=True, shard_dimension=None, shards=1, shard_datasets=None, config=()):
     
     fixup_chain(repo, parent)
 
-    def inner():
-        run = construct_run(parent, pipeline_path)
-        qgraph_file = os.path.join(os.environ.get('TMPDIR', "/tmp"), run.replace("/", "_") + ".qgraph")
-        cmd = [
-            "pipetask",
-            "--long-log", "--log-level", "VERBOSE",
-            "qgraph",
-            "-b", repo,
-            "-p", pipeline_path,
-            "-i", parent,
-            "--output-run", run,
-            "--save-qgraph", qgraph_file,
-            "--qgraph-datastore-records", # for quantum-backed butler
-        ]
-        if data_query:
-            cmd += ["-d", data_query]
-        if skip_existing:
-            cmd += ["--skip-existing-in", parent]
-
-        p = run_and_pipe(cmd)
-        p.wait()
-        if p.returncode != 0:
-            raise RuntimeError("quantum graph generation failed")
-        
-        cmd = [
-            "bps", 
-            "--long-log", "--log-level", "VERBOSE",
-            "submit",
-            f"{os.getcwd()}/pipelines/submit.yaml",
-            # "--wms-service-class", "proc_lsst.shared.service.SharedParslService",
-            "-b", repo,
-            "-i", parent,
-            "--output-run", run,
-            "--qgraph", qgraph_file,
-        ]
-        p = run_and_pipe(cmd)
-        p.wait()
-        if p.returncode != 0:
-            raise RuntimeError("bps submit failed")
+    kwargs = dict(
+        skip_existing=skip_existing, skip_failures=skip_failures, trigger_retry=trigger_retry,
+        loop=loop, executor=executor, cores=cores, incremental=incremental, config=config,
+    )
+    if shard_dimension and shards > 1:
+        # build and submit a graph per shard concurrently, each into a sibling run of the step
+        queries = shard_queries(
+            repo, data_query, shard_dimension, shards,
+            datasets=shard_datasets, collections=parent, pipeline_path=pipeline_path, config=config,
+        )
+        print("sharding", pipeline_path, "into", len(queries), "shards over", shard_dimension, file=sys.stderr)
+        if not queries:
+            return
+        with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+            futures = [
+                pool.submit(_submit, repo, parent, pipeline_path, data_query=query, shard=shard, **kwargs)
+                for shard, query in queries
+            ]
+            for future in futures:
+                future.result()
+    else:
+        _submit(repo, parent, pipeline_path, data_query=data_query, **kwargs)
+
+def _submit(repo, parent, pipeline_path, data_query=None, skip_existing=True, skip_failures=True, trigger_retry=False, loop=False, executor="bps", cores=None, incremental=True, shard=None, config=()):
+
+    def build():
+        # the graph built to check for remaining work is the graph that is submitted
+        run = construct_run(parent, pipeline_path, shard=shard)
+        qgraph_file = qgraph_path(run)
+        bps_config = bps_config_path(run) if executor == "bps" else None
+        if should_run(repo, parent, pipeline_path, data_query=data_query, skip_existing=skip_existing, skip_failures=skip_failures, output_run=run, save_qgraph=qgraph_file, bps_config=bps_config, config=config):
+            return run, qgraph_file, False
+        return None
+
+    def rebuild(run, qgraph_file, attempt):
+        # resubmit the quanta of the previous graph that are still missing into the same run
+        pruned_qgraph_file = qgraph_path(run, attempt)
+        # the memory requested for quanta that ran out of memory is escalated
+        bps_config = bps_config_path(run) if executor == "bps" else None
+        if prune(repo, qgraph_file, pruned_qgraph_file, skip_failures=skip_failures, bps_config=bps_config):
+            return run, pruned_qgraph_file, True
+        return None
+
+    def inner(run, qgraph_file, extend_run=False):
+        if executor == "pipetask":
+            # execute in this process rather than starting another Parsl workflow through bps
+            with Budget().acquire(cores or int(os.environ.get("J", 1))) as lease:
+                cmd = [
+                    "pipetask",
+                    "--long-log", "--log-level", "VERBOSE",
+                    "run",
+                    "-b", repo,
+                    "-i", parent,
+                    "--output-run", run,
+                    "-g", qgraph_file,
+                    "-j", str(lease.cores),
+                    "--register-dataset-types",
+                ]
+                if extend_run:
+                    cmd += ["--extend-run"]
+                p = run_and_pipe(cmd)
+                p.wait()
+            if p.returncode != 0:
+                raise RuntimeError("pipetask run failed")
+        else:
+            cmd = [
+                "bps", 
+                "--long-log", "--log-level", "VERBOSE",
+                "submit",
+                # requests the memory estimated from prior runs of each task, if there are any
+                bps_config_path(run) if os.path.exists(bps_config_path(run)) else f"{os.getcwd()}/pipelines/submit.yaml",
+                # "--wms-service-class", "proc_lsst.shared.service.SharedParslService",
+                "-b", repo,
+                "-i", parent,
+                "--output-run", run,
+                "--qgraph", qgraph_file,
+            ]
+            p = run_and_pipe(cmd)
+            p.wait()
+            if p.returncode != 0:
+                raise RuntimeError("bps submit failed")
         
         if trigger_retry:
             cmd = [
@@ -169,17 +375,23 @@ def submit(repo, parent, pipeline_path, data_query=None, skip_existing=True, ski
 
         fixup_chain(repo, parent) # append run to chain
 
-    check = lambda : should_run(repo, parent, pipeline_path, data_query=data_query, skip_existing=skip_existing, skip_failures=skip_failures)
-
     if loop:
         if skip_existing and skip_failures:
             # continue generating qgraph and running until there are no more failures
-            while check():
-                inner()
+            built = build()
+            attempt = 0
+            while built is not None:
+                inner(*built)
+                attempt += 1
+                run, qgraph_file, _ = built
+                built = rebuild(run, qgraph_file, attempt) if incremental else None
+                if built is None:
+                    # nothing left of the previous graph; check for any other work
+                    built = build()
     else:
         # run once
-        if (not skip_existing and not skip_failures) or check():
-            inner()
+        if (built := build()) is not None:
+            inner(*built)
 
 
 def main():
@@ -197,6 +409,13 @@ def main():
     parser.add_argument("--no-skip-failures", action="store_true")
     parser.add_argument("--no-loop", action="store_true")
     parser.add_argument("--no-trigger-retry", action="store_true")
+    parser.add_argument("--executor", default="bps", choices=["bps", "pipetask"])
+    parser.add_argument("--cores", "-j", type=int)
+    parser.add_argument("--no-incremental", action="store_true", help="rebuild the whole graph on every --loop pass")
+    parser.add_argument("--shard-dimension", help="split the data query along this dimension, e.g. detector or visit, or comma separated dimensions, e.g. tract,patch")
+    parser.add_argument("--shards", type=int, default=1, help="number of shards to build and submit concurrently")
+    parser.add_argument("--shard-datasets", nargs="+", help="shard over the data IDs with any of these datasets in the parent collection (default: the inputs of the pipeline)")
+    parser.add_argument("--config", "-c", action="append", default=[], help="config override of a task, as label:key=value")
 
     args = parser.parse_args()
     # print(args)
@@ -210,6 +429,13 @@ def main():
         skip_failures=not args.no_skip_failures,
         trigger_retry=not args.no_trigger_retry,
         loop=not args.no_loop,
+        executor=args.executor,
+        cores=args.cores,
+        incremental=not args.no_incremental,
+        shard_dimension=args.shard_dimension,
+        shards=args.shards,
+        shard_datasets=args.shard_datasets,
+        config=args.config,
     )
 
 if __name__ == "__main__":
@@ -62,6 +62,7 @@ def main():
     import argparse
     import astropy.table
     import lsst.daf.butler as dafButler
+    from .budget import Budget
 
     parser = argparse.ArgumentParser()
     parser.add_argument("exposures_file")
@@ -91,7 +92,8 @@ def main():
     downloaded_exposures = astropy.table.Table.read(os.path.join(os.path.join(os.path.dirname(args.exposures_file), "downloaded_" + os.path.basename(args.exposures_file))))
     exposures = astropy.table.join(exposures, downloaded_exposures, keys=["md5sum"])
 
-    ingest(dafButler.Butler(args.repo, writeable=True), args.image_dir, exposures, args.collection, args.collection_keys, processes=args.processes, reingest=args.reingest)
+    with Budget().acquire(args.processes) as lease:
+        ingest(dafButler.Butler(args.repo, writeable=True), args.image_dir, exposures, args.collection, args.collection_keys, processes=lease.cores, reingest=args.reingest)
 
 if __name__ == "__main__":
     main()
@@ -4,10 +4,13 @@ logging.basicConfig()
 logger = logging.getLogger(__name__)
 
 import parsl
-from parsl import bash_app
 from parsl.executors import HighThroughputExecutor
-from .parsl import EpycProvider, KloneAstroProvider, KloneA40Provider, run_command
+from .parsl import EpycProvider, KloneAstroProvider, KloneA40Provider
+from .workflow import StepGraph, thread_executor
+from .collection import CollectionChainManager, chain_command
+from .state import StateDB
 from functools import partial
+import os
 
 proc_to_obs = dict(
     bias="zero",
@@ -16,11 +19,166 @@ proc_to_obs = dict(
     drp="object",
 )
 
+proc_steps = dict(
+    bias=["step1", "step2"],
+    flat=["step0", "step1", "step2", "step3"],
+    science=["step0", "step1"],
+    drp=["step0", "step1", "step2a", "step2b", "step2c", "step2d", "step2e", "step2f", "step3a"],
+    diff_drp=["step4a", "step4b", "step4c", "step4d", "step4e"],
+)
+
+# the certified calibrations consumed by the pipeline of each proc type
+proc_calibrations = dict(
+    bias=[],
+    flat=["bias"],
+    science=["bias", "flat"],
+    drp=["bias", "flat"],
+    diff_drp=[],
+)
+
+# relative cost of each kind of step, used to find the critical path
+step_costs = dict(
+    ingest=2,
+    raw=1,
+    collection=1,
+    define_visits=1,
+    pipeline=10,
+    decertify=1,
+    certify=1,
+)
+
+def add_night(graph, repo, exposures, night, proc_types, where=None, coadd_subset=None, template_type=None, pipeline_slurm=False, unified=False, cores=None, chains=None):
+    """
+    Add the steps processing a night to a StepGraph
+
+    Ingest, raw tagging, collection and visit definition of each proc type
+    only depend on each other, so they run concurrently across proc types.
+    A pipeline waits on its visits, the certification of the calibrations it
+    consumes and, for difference imaging, on the DRP of the same night.
+    Given a CollectionChainManager, chains are updated in the workflow's
+    process rather than by ``proc-decam collection``.
+    """
+    for proc_type in proc_types:
+        if proc_type not in proc_steps:
+            raise Exception(f"unsupported proc type {proc_type}")
+
+    prepared = {}
+    for proc_type in proc_types:
+        if proc_type in ['bias', 'flat', 'drp']:
+            cmd = [
+                "proc-decam",
+                "ingest",
+                exposures,
+                "-b", repo,
+                "--image-dir", "./data/images",
+                "--select", f"night={night} obs_type='{proc_to_obs[proc_type]}'",
+            ]
+            downloaded = os.path.join(os.path.dirname(exposures), "downloaded_" + os.path.basename(exposures))
+            dep = graph.add(f"ingest_{night}_{proc_type}", cmd, cost=step_costs['ingest'], files=[exposures, downloaded])
+
+            cmd = [
+                "proc-decam",
+                "raw",
+                repo,
+                proc_type,
+                night
+            ]
+            dep = graph.add(f"raw_{night}_{proc_type}", cmd, deps=[dep], cost=step_costs['raw'])
+
+            cmd = chain_command(repo, proc_type, night)
+            func = partial(chains.update, proc_type, night) if chains else None
+            dep = graph.add(f"collection_{night}_{proc_type}", cmd, deps=[dep], cost=step_costs['collection'], func=func)
+
+            cmd = [
+                "butler",
+                "define-visits",
+                repo,
+                "lsst.obs.decam.DarkEnergyCamera",
+                "--collections", f"{night}/{proc_type}",
+            ]
+            prepared[proc_type] = graph.add(f"define_visits_{night}_{proc_type}", cmd, deps=[dep], cost=step_costs['define_visits'])
+
+    done = {}
+    # calibrations are certified before the pipelines that consume them
+    for proc_type in sorted(proc_types, key=lambda x : list(proc_steps.keys()).index(x)):
+        steps = proc_steps[proc_type]
+        deps = [prepared.get(proc_type)] + [done.get(calibration) for calibration in proc_calibrations[proc_type]]
+
+        _coadd_subset, _template_type = "", ""
+        if proc_type in ["science", "drp", "diff_drp"]:
+            _coadd_subset, _template_type = coadd_subset or "", template_type or ""
+
+        if proc_type == "diff_drp":
+            cmd = chain_command(repo, proc_type, night, coadd_subset=_coadd_subset, template_type=_template_type)
+            func = partial(chains.update, proc_type, night, coadd_subset=_coadd_subset, template_type=_template_type) if chains else None
+            deps = [graph.add(f"collection_{night}_{proc_type}", cmd, deps=[done.get("drp")], cost=step_costs['collection'], func=func)]
+
+        if unified:
+            # expand the pipeline into this workflow
+            from .pipeline import add_pipeline
+            deps = add_pipeline(
+                graph,
+                repo,
+                proc_type,
+                [os.path.normpath(f"{night}/{_coadd_subset}/{_template_type}/{proc_type}")],
+                steps,
+                where=where,
+                template_type=_template_type,
+                coadd_subset=_coadd_subset,
+                deps=deps,
+                executor="pipetask",
+                cores=cores,
+                cost=step_costs['pipeline'],
+                chains=chains,
+            )
+        else:
+            cmd = [
+                "proc-decam",
+                "pipeline",
+                repo,
+                proc_type,
+                night,
+                "--steps", 
+            ] + steps
+            cmd += ["--slurm"] if pipeline_slurm else []
+            cmd += [f"--where \"{where}\""] if where else []
+            cmd += ["--coadd-subset", _coadd_subset] if _coadd_subset else []
+            cmd += ["--template-type", _template_type] if _template_type else []
+            deps = [graph.add(f"pipeline_{night}_{proc_type}", cmd, deps=deps, cost=step_costs['pipeline'] * len(steps))]
+
+        if proc_type in ["bias", "flat"]:
+            cmd = [
+                "proc-decam",
+                "decertify",
+                repo,
+                f"{night}/calib/{proc_type}",
+                proc_type,
+            ]
+            deps = [graph.add(f"decertify_{night}_{proc_type}", cmd, deps=deps, cost=step_costs['decertify'])]
+
+            cmd = [
+                "butler", 
+                "certify-calibrations", 
+                repo,
+                f"{night}/{proc_type}",
+                f"{night}/calib/{proc_type}",
+                proc_type,
+                "--begin-date",
+                "2000-01-01T00:00:00",
+                "--end-date",
+                "2050-01-01T00:00:00",
+                "--search-all-inputs"
+            ]
+            deps = [graph.add(f"certify_{night}_{proc_type}", cmd, deps=deps, cost=step_costs['certify'])]
+
+        done[proc_type] = deps[-1]
+
+    return done
+
 def main():
     import argparse
     import astropy.table
     import re
-    import os
 
     parser = argparse.ArgumentParser()
     parser.add_argument("repo")
@@ -36,11 +194,45 @@ def main():
     parser.add_argument("--pipeline-slurm", action="store_true")
     parser.add_argument("--provider", default="EpycProvider")
     parser.add_argument("--workers", "-J", type=int, default=4)
+    parser.add_argument("--unified", action="store_true", help="run pipeline and execute steps as apps of this workflow")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="cores shared by all execute steps of a --unified workflow")
+    parser.add_argument("--critical-path", action="store_true", help="print the critical path of the workflow")
+    parser.add_argument("--state-db", default=os.path.join("runinfo", "state.db"), help="database recording the completed steps of workflows")
+    parser.add_argument("--no-resume", action="store_true", help="run all steps, even those that already completed")
+    parser.add_argument("--dry-run", action="store_true", help="construct the workflow without running it")
 
     args = parser.parse_args()
     
     logging.getLogger().setLevel(args.log_level)
 
+    exposures = astropy.table.Table.read(args.exposures)
+    nights = sorted(map(int, list(set(list(filter(lambda x : re.compile(args.nights).match(x), map(str, exposures['night'])))))))
+
+    graph = StepGraph()
+    # the butler is only opened once a chain is updated
+    chains = CollectionChainManager(args.repo)
+    for night in nights:
+        add_night(
+            graph,
+            args.repo,
+            args.exposures,
+            night,
+            args.proc_types,
+            where=args.where,
+            coadd_subset=args.coadd_subset,
+            template_type=args.template_type,
+            pipeline_slurm=args.pipeline_slurm,
+            unified=args.unified,
+            cores=max(1, args.cores // args.workers),
+            chains=chains,
+        )
+
+    if args.critical_path or args.dry_run:
+        graph.print_critical_path()
+    
+    if args.dry_run:
+        return
+
     htex_label = "htex"
     executor_kwargs = dict()
     
@@ -58,246 +250,19 @@ def main():
             HighThroughputExecutor(
                 label=htex_label,
                 **executor_kwargs,
-            )
+            ),
+            thread_executor(),
         ],
         run_dir=os.path.join("runinfo", "night"),
     )
     parsl.load(config)
 
-    exposures = astropy.table.Table.read(args.exposures)
-    nights = sorted(map(int, list(set(list(filter(lambda x : re.compile(args.nights).match(x), map(str, exposures['night'])))))))
-    
-    futures = [] # chage to dictionary
-    for night in nights:
-        inputs = []
-        for proc_type in args.proc_types:
-            if proc_type in ['bias', 'flat', 'drp']:
-                cmd = [
-                    "proc-decam",
-                    "ingest",
-                    args.exposures,
-                    "-b", args.repo,
-                    "--image-dir", "./data/images",
-                    "--select", f"night={night} obs_type='{proc_to_obs[proc_type]}'",
-                ]
-                cmd = " ".join(map(str, cmd))
-                func = partial(run_command)
-                setattr(func, "__name__", f"ingest_{night}_{proc_type}")
-                future = bash_app(func)(cmd, inputs=inputs)
-                inputs = [future]
-                futures.append(future)
-            
-                cmd = [
-                    "proc-decam",
-                    "raw",
-                    args.repo,
-                    proc_type,
-                    night
-                ]
-                cmd = " ".join(map(str, cmd))
-                func = partial(run_command)
-                setattr(func, "__name__", f"raw_{night}_{proc_type}")
-                future = bash_app(func)(cmd, inputs=inputs)
-                inputs = [future]
-                futures.append(future)
-            
-                cmd = [
-                    "proc-decam",
-                    "collection",
-                    args.repo,
-                    proc_type,
-                    night
-                ]
-                cmd = " ".join(map(str, cmd))
-                func = partial(run_command)
-                setattr(func, "__name__", f"collection_{night}_{proc_type}")
-                future = bash_app(func)(cmd, inputs=inputs)
-                inputs = [future]
-                futures.append(future)
-
-                cmd = [
-                    "butler",
-                    "define-visits",
-                    args.repo,
-                    "lsst.obs.decam.DarkEnergyCamera",
-                    "--collections", f"{night}/{proc_type}",
-                ]
-                cmd = " ".join(map(str, cmd))
-                func = partial(run_command)
-                setattr(func, "__name__", f"define_visits_{night}_{proc_type}")
-                future = bash_app(func)(cmd, inputs=inputs)
-                inputs = [future]
-                futures.append(future)
-
-            if proc_type == "bias":
-                steps = ["step1", "step2"]
-                cmd = [
-                    "proc-decam",
-                    "pipeline",
-                    args.repo,
-                    proc_type,
-                    night,
-                    "--steps"
-                ] + steps
-                cmd += ["--slurm"] if args.pipeline_slurm else []
-                cmd += [f"--where \"{args.where}\""] if args.where else []
-
-                cmd = " ".join(map(str, cmd))
-                func = partial(run_command)
-                setattr(func, "__name__", f"pipeline_{night}_{proc_type}")
-                future = bash_app(func)(cmd, inputs=inputs)
-                inputs = [future]
-                futures.append(future)
-
-                cmd = [
-                    "proc-decam",
-                    "decertify",
-                    args.repo,
-                    f"{night}/calib/{proc_type}",
-                    proc_type,
-                ]
-                cmd = " ".join(map(str, cmd))
-                func = partial(run_command)
-                setattr(func, "__name__", f"decertify_{night}_{proc_type}")
-                future = bash_app(func)(cmd, inputs=inputs)
-                inputs = [future]
-                futures.append(future)
-
-                cmd = [
-                    "butler", 
-                    "certify-calibrations", 
-                    args.repo,
-                    f"{night}/{proc_type}",
-                    f"{night}/calib/{proc_type}",
-                    proc_type,
-                    "--begin-date",
-                    "2000-01-01T00:00:00",
-                    "--end-date",
-                    "2050-01-01T00:00:00",
-                    "--search-all-inputs"
-                ]
-                cmd = " ".join(map(str, cmd))
-                func = partial(run_command)
-                setattr(func, "__name__", f"certify_{night}_{proc_type}")
-                future = bash_app(func)(cmd, inputs=inputs)
-                inputs = [future]
-                futures.append(future)
-
-            elif proc_type == "flat":
-                steps = ["step0", "step1", "step2", "step3"]
-                cmd = [
-                    "proc-decam",
-                    "pipeline",
-                    args.repo,
-                    proc_type,
-                    night,
-                    "--steps"
-                ] + steps
-                cmd += ["--slurm"] if args.pipeline_slurm else []
-                cmd += [f"--where \"{args.where}\""] if args.where else []
-
-                cmd = " ".join(map(str, cmd))
-                func = partial(run_command)
-                setattr(func, "__name__", f"pipeline_{night}_{proc_type}")
-                future = bash_app(func)(cmd, inputs=inputs)
-                inputs = [future]
-                futures.append(future)
-
-                cmd = [
-                    "proc-decam",
-                    "decertify",
-                    args.repo,
-                    f"{night}/calib/{proc_type}",
-                    proc_type,
-                ]
-                cmd = " ".join(map(str, cmd))
-                func = partial(run_command)
-                setattr(func, "__name__", f"decertify_{night}_{proc_type}")
-                future = bash_app(func)(cmd, inputs=inputs)
-                inputs = [future]
-                futures.append(future)
-
-                cmd = [
-                    "butler", 
-                    "certify-calibrations", 
-                    args.repo,
-                    f"{night}/{proc_type}",
-                    f"{night}/calib/{proc_type}",
-                    proc_type,
-                    "--begin-date",
-                    "2000-01-01T00:00:00",
-                    "--end-date",
-                    "2050-01-01T00:00:00",
-                    "--search-all-inputs"
-                ]
-                cmd = " ".join(map(str, cmd))
-                func = partial(run_command)
-                setattr(func, "__name__", f"certify_{night}_{proc_type}")
-                future = bash_app(func)(cmd, inputs=inputs)
-                inputs = [future]
-                futures.append(future)
-
-            elif proc_type in ["science", "drp", "diff_drp"]:
-                if proc_type == "science":
-                    steps = ["step0", "step1"]
-                elif proc_type == "drp":
-                    steps = ["step0", "step1", "step2a", "step2b", "step2c", "step2d", "step2e", "step2f", "step3a"]
-                elif proc_type == "diff_drp":
-                    steps = ["step4a", "step4b", "step4c", "step4d", "step4e"]
-                else:
-                    raise Exception(f"unsupported proc type {proc_type}")
-                
-                if proc_type == "diff_drp":
-                    cmd = [
-                        "proc-decam",
-                        "collection",
-                        args.repo,
-                        proc_type,
-                        night
-                    ]
-                    cmd += ["--coadd-subset", args.coadd_subset] if args.coadd_subset else []
-                    cmd += ["--template-type", args.template_type] if args.template_type else []
-                    cmd = " ".join(map(str, cmd))
-                    func = partial(run_command)
-                    setattr(func, "__name__", f"collection_{night}_{proc_type}")
-                    future = bash_app(func)(cmd, inputs=inputs)
-                    inputs = [future]
-                    futures.append(future)
-
-                cmd = [
-                    "proc-decam",
-                    "pipeline",
-                    args.repo,
-                    proc_type,
-                    night,
-                    "--steps", 
-                ] + steps
-                cmd += ["--slurm"] if args.pipeline_slurm else []
-                cmd += [f"--where \"{args.where}\""] if args.where else []
-                cmd += ["--coadd-subset", args.coadd_subset] if args.coadd_subset else []
-                cmd += ["--template-type", args.template_type] if args.template_type else []
-
-                cmd = " ".join(map(str, cmd))
-                func = partial(run_command)
-                setattr(func, "__name__", f"pipeline_{night}_{proc_type}")
-                future = bash_app(func)(cmd, inputs=inputs)
-                inputs = [future]
-                futures.append(future)
-            else:
-                raise Exception(f"unsupported proc type {proc_type}")
-    
-    for future in futures:
+    futures = graph.submit(state=StateDB(args.state_db), resume=not args.no_resume)
+    for future in futures.values():
         if future:
             future.exception()
     
     parsl.dfk().cleanup()
-    # tag bias
-    # make collection
-    # make bias
-    # certify bias
-    # tag flat
-    # make flat
-    # certify flat
         
 if __name__ == "__main__":
     main()
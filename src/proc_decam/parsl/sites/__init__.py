@@ -1,3 +1,3 @@
-# from .klone import *
+from .klone import *
 # from .epyc import *
 from .local import *
\ No newline at end of file
@@ -9,9 +9,14 @@ from parsl.executors import HighThroughputExecutor
 from parsl.executors.base import ParslExecutor
 from parsl.providers import LocalProvider
 
+from ...budget import Budget
+
 __all__ = ("Epyc",)
 
 class Epyc(Local):
     def get_executors(self) -> List[ParslExecutor]:    
         cores = int(os.environ.get("J", get_bps_config_value(self.site, "cores", int, required=True)))
+        memory_per_core = get_bps_config_value(self.site, "memory_per_core", float, 0.0)
+        # held until bps exits
+        cores = Budget().acquire(cores, memory=cores * memory_per_core or None).cores
         return [HighThroughputExecutor("local", provider=LocalProvider(), max_workers_per_node=cores)]
@@ -0,0 +1,126 @@
+from typing import TYPE_CHECKING, List
+
+import logging
+import os
+
+from lsst.ctrl.bps.parsl.configuration import get_bps_config_value
+from lsst.ctrl.bps.parsl.sites import Slurm
+from parsl.executors import HighThroughputExecutor
+from parsl.executors.base import ParslExecutor
+import parsl.config
+
+from ..providers import KloneAstroProvider, KloneCheckpointProvider
+
+__all__ = ("Klone",)
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+# failures of tasks whose worker or block went away, e.g. when a block on the
+# checkpoint partition is preempted, rather than failures of the task itself
+preemption_errors = ("WorkerLost", "ManagerLost")
+# exit codes of commands killed by the SIGTERM slurm sends on preemption
+preemption_exit_codes = (-15, 143)
+
+def walltime_seconds(walltime):
+    seconds = 0
+    for part in str(walltime).split(":"):
+        seconds = 60 * seconds + int(part)
+    return seconds
+
+def is_preemption(exception):
+    if type(exception).__name__ in preemption_errors:
+        return True
+    return getattr(exception, "exitcode", None) in preemption_exit_codes
+
+class Klone(Slurm):
+    """
+    Runs jobs on blocks of the preemptible checkpoint partition, keeping jobs
+    that are expected to run longer than a checkpoint block lasts on the
+    astro partition
+
+    Jobs lost to preemption are retried on their own without counting
+    against the site's ``retries``, up to ``max_preemptions`` times each.
+    """
+    def get_executors(self) -> List[ParslExecutor]:
+        worker_init = f"source {os.path.join(os.getcwd(), 'etc/worker_setup.sh')}"
+        ckpt_blocks = get_bps_config_value(self.site, "ckpt_blocks", int, KloneCheckpointProvider.defaults['max_blocks'])
+        astro_blocks = get_bps_config_value(self.site, "astro_blocks", int, KloneAstroProvider.defaults['max_blocks'])
+        cores_per_node = get_bps_config_value(self.site, "cores_per_node", int, 1)
+        mem_per_node = get_bps_config_value(self.site, "mem_per_node", int, 8)
+        return [
+            HighThroughputExecutor(
+                "ckpt",
+                provider=KloneCheckpointProvider(
+                    max_blocks=ckpt_blocks,
+                    cores_per_node=cores_per_node,
+                    mem_per_node=mem_per_node,
+                    worker_init=worker_init,
+                ),
+                max_workers_per_node=cores_per_node,
+            ),
+            HighThroughputExecutor(
+                "astro",
+                provider=KloneAstroProvider(
+                    max_blocks=astro_blocks,
+                    cores_per_node=cores_per_node,
+                    mem_per_node=mem_per_node,
+                    worker_init=worker_init,
+                ),
+                max_workers_per_node=cores_per_node,
+            ),
+        ]
+
+    def worker_memory(self) -> float:
+        """The memory in MB of a worker on a block"""
+        cores_per_node = get_bps_config_value(self.site, "cores_per_node", int, 1)
+        mem_per_node = get_bps_config_value(self.site, "mem_per_node", int, 8)
+        return 1024 * mem_per_node / cores_per_node
+
+    def select_executor(self, job: "ParslJob") -> str:
+        """Get the ``label`` of the executor to use to execute a job
+
+        A job goes to the checkpoint partition unless its ``requestWalltime``
+        exceeds ``ckpt_max_runtime`` (by default half of the checkpoint
+        walltime, as a block may be part way through its walltime when the
+        job starts), or its ``requestMemory`` exceeds ``ckpt_max_memory``
+        (by default the memory of a worker), as a job that needs longer or
+        more memory is the most costly to lose to preemption.
+        """
+        walltime = walltime_seconds(KloneCheckpointProvider.defaults['walltime'])
+        max_runtime = get_bps_config_value(self.site, "ckpt_max_runtime", int, walltime // 2)
+        max_memory = get_bps_config_value(self.site, "ckpt_max_memory", float, self.worker_memory())
+        request_walltime = getattr(job.generic, "request_walltime", None)
+        if request_walltime and int(float(request_walltime)) > max_runtime:
+            return "astro"
+        request_memory = getattr(job.generic, "request_memory", None)
+        if request_memory and float(request_memory) > max_memory:
+            return "astro"
+        return "ckpt"
+
+    def retry_handler(self, exception, task_record) -> float:
+        # the cost of a failure counted against retries
+        if is_preemption(exception):
+            preemptions = task_record.setdefault("preemptions", 0) + 1
+            task_record["preemptions"] = preemptions
+            max_preemptions = get_bps_config_value(self.site, "max_preemptions", int, 10)
+            if preemptions <= max_preemptions:
+                logger.info("task %s was preempted (%s), requeueing", task_record['id'], type(exception).__name__)
+                return 0
+        return 1
+
+    def get_parsl_config(self) -> parsl.config.Config:
+        executors = self.get_executors()
+        monitor = self.get_monitor()
+        retries = get_bps_config_value(self.site, "retries", int, 1)
+        run_dir = get_bps_config_value(self.site, "run_dir", str, "runinfo")
+        strategy = get_bps_config_value(self.site, "strategy", str, "htex_auto_scale")
+        return parsl.config.Config(
+            executors=executors,
+            monitoring=monitor,
+            retries=retries,
+            retry_handler=self.retry_handler,
+            checkpoint_mode="task_exit",
+            run_dir=run_dir,
+            strategy=strategy,
+        )
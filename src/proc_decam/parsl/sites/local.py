@@ -10,26 +10,65 @@ from parsl.executors.base import ParslExecutor
 from parsl.providers import LocalProvider
 import parsl.config
 
+from ...budget import Budget
+
 
 __all__ = ("Local",)
 
 class Local(bps_Local):
-    def get_executors(self) -> List[ParslExecutor]:    
-        cores = int(os.environ.get("J", get_bps_config_value(self.site, "cores", int, required=True)))
-        return [
-            HighThroughputExecutor(
-                "local", 
-                provider=LocalProvider(
-                    min_blocks=0,
-                    max_blocks=1,
-                    worker_init=f"""
+    def _executor(self, label, workers):
+        return HighThroughputExecutor(
+            label, 
+            provider=LocalProvider(
+                min_blocks=0,
+                max_blocks=1,
+                worker_init=f"""
 source {os.path.join(os.getcwd(), 'etc/worker_setup.sh')}
 """,
-                ), 
-                max_workers=cores,
-                worker_debug=True,
-            )
-        ]
+            ), 
+            max_workers=workers,
+            worker_debug=True,
+        )
+
+    def get_executors(self) -> List[ParslExecutor]:    
+        cores = int(os.environ.get("J", get_bps_config_value(self.site, "cores", int, required=True)))
+        budget = Budget()
+        memory_per_core = get_bps_config_value(self.site, "memory_per_core", float, 0.0) or budget.memory / budget.cores
+        highmem_workers = get_bps_config_value(self.site, "highmem_workers", int, 0)
+        highmem_memory = get_bps_config_value(self.site, "highmem_memory", float, 4 * memory_per_core)
+
+        # the local and highmem workers share one lease (held until bps exits),
+        # so concurrent submissions never hold one lease while waiting on another
+        requested = cores + highmem_workers
+        lease = budget.acquire(
+            requested,
+            memory=cores * memory_per_core + highmem_workers * highmem_memory,
+            minimum=2 if highmem_workers > 0 else 1,
+        )
+        # a smaller grant shrinks both executors in proportion
+        highmem_cores = 0
+        if highmem_workers > 0:
+            highmem_cores = min(lease.cores - 1, max(1, round(highmem_workers * lease.cores / requested)))
+        executors = [self._executor("local", lease.cores - highmem_cores)]
+
+        # jobs requesting more memory than a worker has run with fewer workers
+        self.worker_memory = 1024 * memory_per_core
+        self.highmem = highmem_cores > 0
+        if self.highmem:
+            executors.append(self._executor("highmem", highmem_cores))
+        return executors
+
+    def select_executor(self, job: "ParslJob") -> str:
+        """Get the ``label`` of the executor to use to execute a job
+
+        Jobs whose ``requestMemory`` exceeds the memory of a worker of the
+        ``local`` executor are routed to the ``highmem`` executor, if the
+        site has ``highmem_workers`` and the budget granted cores for them.
+        """
+        request_memory = getattr(job.generic, "request_memory", None) or 0
+        if self.highmem and request_memory > self.worker_memory:
+            return "highmem"
+        return "local"
     
     def get_parsl_config(self) -> parsl.config.Config:
         """Get Parsl configuration for using CC-IN2P3 Slurm farm as a
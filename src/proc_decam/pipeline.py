@@ -20,6 +20,7 @@ and a set of command line commands to run
 """
 import logging
 import os
+from functools import partial
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -34,20 +35,90 @@ pipelines = dict(
         "median": "median-template.yaml",
         "meanclip": "meanclip-template.yaml",
         "min": "min-template.yaml",
+        "multi": "multi-template.yaml",
         "": "template.yaml",
         None: "template.yaml",
     },
     diff_drp="DRP.yaml",
 )
 
+# template types of difference imaging that read one statistic of the
+# multi-statistic coadd, e.g. multi-median
+multi_template_prefix = "multi-"
+
+def template_config(proc_type, template_type):
+    """
+    Config overrides selecting the template of a multi-statistic coadd
+    """
+    if proc_type == "diff_drp" and template_type and template_type.startswith(multi_template_prefix):
+        statistic = template_type[len(multi_template_prefix):]
+        return [f"getTemplate:connections.coaddExposures=deepCoadd_{statistic}"]
+    return []
+
 if not os.path.exists(os.path.join(os.getcwd(), "pipelines")):
     raise RuntimeError("Cannot find directory 'pipelines' in the current working directory")
 
 import parsl
-from parsl import bash_app
 from parsl.executors import HighThroughputExecutor
-from .parsl import EpycProvider, KloneA40Provider, run_command
-from functools import partial
+from .parsl import EpycProvider, KloneA40Provider
+from .workflow import StepGraph, thread_executor
+from .state import StateDB
+from .collection import CollectionChainManager, chain_command
+
+def add_pipeline(graph, repo, proc_type, collections, steps, where=None, template_type="", coadd_subset="", deps=(), executor="bps", cores=None, cost=10, shard_dimension=None, shards=1, shard_datasets=(), chains=None):
+    """
+    Add the collection and execute steps of a pipeline to a StepGraph,
+    returning the names of the last step added for each collection
+
+    The steps of each collection are chained in order, with the first step
+    depending on ``deps``. With ``executor="pipetask"`` each step is executed
+    in-process by ``pipetask run -j cores`` so that no nested Parsl workflow is
+    started by ``bps submit``. With ``shard_dimension`` each step is split
+    into ``shards`` graphs that are built and submitted concurrently; it may
+    be a dictionary of step to dimension, in which case steps missing from it
+    are not sharded. Given a
+    CollectionChainManager, chains are updated in the workflow's process.
+    """
+    pipeline = pipelines[proc_type]
+    if proc_type == "coadd":
+        pipeline = pipeline[template_type]
+    last = []
+    for collection in collections:
+        l = collection.split("/")
+        subset = l[0]
+        _deps = list(deps)
+        cmd = chain_command(repo, proc_type, subset, coadd_subset=coadd_subset, template_type=template_type)
+        func = partial(chains.update, proc_type, subset, coadd_subset=coadd_subset, template_type=template_type) if chains else None
+        for step in steps:
+            _deps = [graph.add(f"collection_{subset}_{proc_type}_{step}", cmd, deps=_deps, func=func)]
+
+            execute_cmd = [
+                "proc-decam",
+                "execute",
+                repo,
+                collection,
+                "--pipeline", f"{os.getcwd()}/pipelines/{pipeline}#{step}",
+            ]
+            if where:
+                execute_cmd += [f"--where \"{where}\""]
+            for config in template_config(proc_type, template_type):
+                execute_cmd += ["--config", config]
+            if executor != "bps":
+                execute_cmd += ["--executor", executor]
+            if cores:
+                execute_cmd += ["--cores", cores]
+            dimension = shard_dimension.get(step) if isinstance(shard_dimension, dict) else shard_dimension
+            if dimension and shards > 1:
+                execute_cmd += ["--shard-dimension", dimension, "--shards", shards]
+                if shard_datasets:
+                    execute_cmd += ["--shard-datasets"] + list(shard_datasets)
+            _deps = [graph.add(f"execute_{subset}_{proc_type}_{step}", execute_cmd, deps=_deps, cost=cost, files=[f"{os.getcwd()}/pipelines/{pipeline}"])]
+            # put final job in here?
+            # in case the final job never ran...?
+            _deps = [graph.add(f"collection_{subset}_{proc_type}_{step}_done", cmd, deps=_deps, func=func)]
+        last.extend(_deps)
+
+    return last
 
 def main():
     import argparse
@@ -66,6 +137,13 @@ def main():
     parser.add_argument("--log-level", default="INFO")
     parser.add_argument("--slurm", action="store_true")
     parser.add_argument("--workers", "-J", type=int, default=4)
+    parser.add_argument("--executor", default="bps", choices=["bps", "pipetask"])
+    parser.add_argument("--cores", type=int)
+    parser.add_argument("--shard-dimension", help="split the data query of each step along this dimension")
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--critical-path", action="store_true", help="print the critical path of the workflow")
+    parser.add_argument("--state-db", default=os.path.join("runinfo", "state.db"), help="database recording the completed steps of workflows")
+    parser.add_argument("--no-resume", action="store_true", help="run all steps, even those that already completed")
 
     args = parser.parse_args()
     
@@ -88,7 +166,8 @@ def main():
             HighThroughputExecutor(
                 label=htex_label,
                 **executor_kwargs,
-            )
+            ),
+            thread_executor(),
         ],
         run_dir=os.path.join("runinfo", "pipeline"),
     )
@@ -102,70 +181,28 @@ def main():
         collectionTypes=CollectionType.CHAINED
     )
 
-    pipeline = pipelines[args.proc_type]
-    if args.proc_type == "coadd":
-        pipeline = pipeline[args.template_type]
-    futures = []
-    for collection in collections:
-        l = collection.split("/")
-        subset = l[0]
-        inputs = []
-        for step in args.steps:
-            cmd = [
-                "proc-decam",
-                "collection",
-                args.repo,
-                args.proc_type,
-                subset,
-            ]
-            if args.template_type:
-                cmd += ["--template-type", args.template_type]
-            if args.coadd_subset:
-                cmd += ["--coadd-subset", args.coadd_subset]
-
-            cmd = " ".join(map(str, cmd))
-            func = partial(run_command)
-            setattr(func, "__name__", f"collection_{subset}_{args.proc_type}_{step}")
-            future = bash_app(func)(cmd, inputs=inputs)
-            inputs = [future]
-            futures.append(future)
-
-            cmd = [
-                "proc-decam",
-                "execute",
-                args.repo,
-                collection,
-                "--pipeline", f"{os.getcwd()}/pipelines/{pipeline}#{step}",
-            ]
-            if args.where:
-                cmd += [f"--where \"{args.where}\""]
-            cmd = " ".join(map(str, cmd))
-            func = partial(run_command)
-            setattr(func, "__name__", f"execute_{subset}_{args.proc_type}_{step}")
-            future = bash_app(func)(cmd, inputs=inputs)
-            inputs = [future]
-            futures.append(future)
-            # put final job in here?
-            # in case the final job never ran...?
-            cmd = [
-                "proc-decam",
-                "collection",
-                args.repo,
-                args.proc_type,
-                subset,
-            ]
-            if args.template_type:
-                cmd += ["--template-type", args.template_type]
-            if args.coadd_subset:
-                cmd += ["--coadd-subset", args.coadd_subset]
-            cmd = " ".join(map(str, cmd))
-            func = partial(run_command)
-            setattr(func, "__name__", f"collection_{subset}_{args.proc_type}_{step}")
-            future = bash_app(func)(cmd, inputs=inputs)
-            inputs = [future]
-            futures.append(future)
-    
-    for future in futures:
+    graph = StepGraph()
+    add_pipeline(
+        graph,
+        args.repo,
+        args.proc_type,
+        collections,
+        args.steps,
+        where=args.where,
+        template_type=args.template_type,
+        coadd_subset=args.coadd_subset,
+        executor=args.executor,
+        cores=args.cores,
+        shard_dimension=args.shard_dimension,
+        shards=args.shards,
+        chains=CollectionChainManager(args.repo),
+    )
+
+    if args.critical_path:
+        graph.print_critical_path()
+
+    futures = graph.submit(state=StateDB(args.state_db), resume=not args.no_resume)
+    for future in futures.values():
         if future:
             future.exception()
 
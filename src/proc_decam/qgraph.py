@@ -1,12 +1,19 @@
 import lsst.daf.butler as dafButler
 from lsst.pipe.base.quantum_graph_builder import QuantumGraphBuilder
+from lsst.pipe.base.graph import QuantumGraph
 from lsst.pipe.base.all_dimensions_quantum_graph_builder import AllDimensionsQuantumGraphBuilder
 from lsst.pipe.base.pipeline_graph import PipelineGraph
 from lsst.pipe.base.pipeline import Pipeline
-from lsst.pipe.base.quantum_graph_skeleton import DatasetKey
+from lsst.utils.iteration import ensure_iterable
+import datetime
+import getpass
+import glob
+import hashlib
 import os
 import argparse
 import logging
+from collections import defaultdict
+from functools import partial
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -15,55 +22,74 @@ logging.getLogger().setLevel(25)
 class SkipFailuresQuantumGraphBuilder(AllDimensionsQuantumGraphBuilder):
     """
     Optionally skip tasks which have previously failed
+
+    A quantum has failed when its log exists in the skip-existing collections
+    but its metadata does not. The failed data IDs of each task are found in
+    one pass over the existing outputs before its quanta are walked, and the
+    outputs of skipped quanta are removed from the skeleton together.
     """
     def __init__(self, *args, skip_failures=True, **kwargs):
         self.skip_failures = skip_failures
+        self._existing_data_ids = None
+        self._failed = set()
+        self._removed_outputs = []
+        self.skipped_failures = 0
         super().__init__(*args, **kwargs)
-        
+
+    def _failed_data_ids(self, task_node):
+        if self._existing_data_ids is None:
+            # index the existing outputs by dataset type once per build
+            self._existing_data_ids = defaultdict(set)
+            for key in self.existing_datasets.outputs_for_skip.keys():
+                self._existing_data_ids[key.parent_dataset_type_name].add(key.data_id_values)
+        logs = self._existing_data_ids.get(task_node.log_output.parent_dataset_type_name, set())
+        metadata = self._existing_data_ids.get(task_node.metadata_output.parent_dataset_type_name, set())
+        return logs - metadata
+
+    def _resolve_task_quanta(self, task_node, skeleton):
+        self._failed = self._failed_data_ids(task_node) if self.skip_failures else set()
+        self._removed_outputs = []
+        skipped = self.skipped_failures
+        super()._resolve_task_quanta(task_node, skeleton)
+        if self._removed_outputs:
+            skeleton.remove_dataset_nodes(self._removed_outputs)
+        if self.skipped_failures > skipped:
+            logger.info(
+                "skipping %d failed quanta of %s and removing %d of their outputs",
+                self.skipped_failures - skipped, task_node.label, len(self._removed_outputs)
+            )
+        self._failed = set()
+        self._removed_outputs = []
+
     def _skip_quantum_if_metadata_exists(self, task_node, quantum_key, skeleton):
         skip = super()._skip_quantum_if_metadata_exists(task_node, quantum_key, skeleton)
-        if self.skip_failures:
-            if not skip:
-                # if the metadata does not exist, check that the log exists
-                log_dataset_key = DatasetKey(
-                    task_node.log_output.parent_dataset_type_name, quantum_key.data_id_values
-                )
-                # print(log_dataset_key)
-                if log_dataset_key in self.existing_datasets.outputs_for_skip:
-                    print("skipping", log_dataset_key)
-                    # This quantum's metadata is already present in the the
-                    # skip_existing_in collections; we'll skip it.  But the presence of
-                    # the metadata dataset doesn't guarantee that all of the other
-                    # outputs we predicted are present; we have to check.
-                    for output_dataset_key in list(skeleton.iter_outputs_of(quantum_key)):
-                        print("  removing output", output_dataset_key)
-                        if (
-                            output_ref := self.existing_datasets.outputs_for_skip.get(output_dataset_key)
-                        ) is not None:
-                            # Populate the skeleton graph's node attributes
-                            # with the existing DatasetRef, just like a
-                            # predicted output of a non-skipped quantum.
-                            print("    replacing as output", output_ref)
-                            skeleton[output_dataset_key]["ref"] = output_ref
-                        else:
-                            # Remove this dataset from the skeleton graph,
-                            # because the quantum that would have produced it
-                            # is being skipped and it doesn't already exist.
-                            print("    removing dataset node", output_dataset_key)
-                            skeleton.remove_dataset_nodes([output_dataset_key])
-                        # If this dataset was "in the way" (i.e. already in the
-                        # output run), it isn't anymore.
-                        self.existing_datasets.outputs_in_the_way.pop(output_dataset_key, None)
-                    # Removing the quantum node from the graph will happen outside this
-                    # function.
-                    return True
-                # else:
-                #     print("not skipping", log_dataset_key)
-                return False    
-        
-        return skip
-    
-def create_qgraph(butler, pipeline_graph, input_collections, output_run=None, skip_failures=True, clobber=False, skip_existing_in=None, where=None):
+        if skip or quantum_key.data_id_values not in self._failed:
+            return skip
+
+        # the same handling of outputs as a quantum skipped because its
+        # metadata exists, except dataset nodes are removed after the walk
+        for output_dataset_key in skeleton.iter_outputs_of(quantum_key):
+            if (
+                output_ref := self.existing_datasets.outputs_for_skip.get(output_dataset_key)
+            ) is not None:
+                # Populate the skeleton graph's node attributes
+                # with the existing DatasetRef, just like a
+                # predicted output of a non-skipped quantum.
+                skeleton[output_dataset_key]["ref"] = output_ref
+            else:
+                # Remove this dataset from the skeleton graph,
+                # because the quantum that would have produced it
+                # is being skipped and it doesn't already exist.
+                self._removed_outputs.append(output_dataset_key)
+            # If this dataset was "in the way" (i.e. already in the
+            # output run), it isn't anymore.
+            self.existing_datasets.outputs_in_the_way.pop(output_dataset_key, None)
+        self.skipped_failures += 1
+        # Removing the quantum node from the graph will happen outside this
+        # function.
+        return True
+
+def create_qgraph(butler, pipeline_graph, input_collections, output_run=None, skip_failures=True, clobber=False, skip_existing_in=None, where=None, attach_datastore_records=False, metadata=None):
     builder = SkipFailuresQuantumGraphBuilder(
         pipeline_graph,
         butler,
@@ -74,13 +100,469 @@ def create_qgraph(butler, pipeline_graph, input_collections, output_run=None, sk
         skip_failures=skip_failures,
         clobber=clobber,
     )
-    metadata = dict()
+    # the same metadata as pipetask qgraph, so that bps can submit the saved graph
+    metadata = dict(metadata or {}) | dict(
+        input=list(ensure_iterable(input_collections)),
+        skip_existing_in=list(ensure_iterable(skip_existing_in)) if skip_existing_in else [],
+        skip_existing=bool(skip_existing_in),
+        data_query=where,
+        user=getpass.getuser(),
+        time=str(datetime.datetime.now()),
+    )
     if output_run:
         metadata["output_run"] = output_run
 
-    qgraph = builder.build(metadata) 
+    qgraph = builder.build(metadata, attach_datastore_records=attach_datastore_records) 
+    if builder.skipped_failures:
+        print("skipped", builder.skipped_failures, "previously failed quanta")
     return qgraph   
 
+def pending_quanta(butler, pipeline_graph, collections, where=None, skip_failures=True):
+    """
+    Estimate the quanta of each task that are still to be run, without
+    building a quantum graph
+
+    The expected quanta of a task are the data IDs of its dimensions for which
+    all of its regular inputs exist in ``collections``; a quantum is complete
+    when its ``*_metadata`` (or, with ``skip_failures``, its ``*_log``) exists
+    there too. Returns a dictionary of task label to the number of pending
+    quanta, which is None for tasks that cannot be probed this way.
+    """
+    from lsst.daf.butler.registry import MissingDatasetTypeError
+
+    pipeline_graph.resolve(butler.registry)
+    pending = {}
+    for label, task_node in pipeline_graph.tasks.items():
+        inputs = [edge.parent_dataset_type_name for edge in task_node.inputs.values()]
+        if not inputs:
+            # every data ID of the task's dimensions would be expected
+            pending[label] = None
+            continue
+
+        def data_ids(datasets):
+            try:
+                return set(
+                    butler.registry.queryDataIds(
+                        task_node.dimensions,
+                        datasets=datasets,
+                        collections=collections,
+                        where=where or "",
+                    )
+                )
+            except MissingDatasetTypeError:
+                # the dataset type has never been produced
+                return set()
+
+        expected = data_ids(inputs)
+        if not expected:
+            pending[label] = 0
+            continue
+
+        done = data_ids(inputs + [task_node.metadata_output.parent_dataset_type_name])
+        if skip_failures:
+            done |= data_ids(inputs + [task_node.log_output.parent_dataset_type_name])
+        pending[label] = len(expected - done)
+        logger.debug("%s: %d expected, %d pending", label, len(expected), pending[label])
+
+    return pending
+
+def prune_qgraph(butler, qgraph, skip_failures=True):
+    """
+    Remove the quanta of a submitted graph that have completed (or, with
+    ``skip_failures``, failed) in its output run, along with the quanta
+    downstream of failures
+
+    Outputs already written to the run by the remaining quanta, e.g. by a
+    quantum that ran out of memory, are pruned so they can be written again.
+    The registry is only queried for the datasets of the graph, once per
+    dataset type.
+    """
+    import networkx as nx
+
+    run = qgraph.metadata["output_run"]
+
+    def existing_ids(dataset_type_name):
+        return {ref.id for ref in butler.registry.queryDatasets(dataset_type_name, collections=run)}
+
+    completed = set()
+    failed = set()
+    for task_def in qgraph.iterTaskGraph():
+        nodes = qgraph.getNodesForTask(task_def)
+        metadata_ids = existing_ids(task_def.metadataDatasetName)
+        log_ids = existing_ids(task_def.logOutputDatasetName) if skip_failures else set()
+        for node in nodes:
+            outputs = node.quantum.outputs
+            if outputs[task_def.metadataDatasetName][0].id in metadata_ids:
+                completed.add(node)
+            elif outputs[task_def.logOutputDatasetName][0].id in log_ids:
+                failed.add(node)
+
+    blocked = set()
+    for node in failed:
+        blocked |= nx.descendants(qgraph.graph, node)
+
+    remaining = [node for node in qgraph if node not in completed and node not in failed and node not in blocked]
+    logger.info(
+        "%d quanta completed, %d failed and %d blocked by failures; %d of %d remaining",
+        len(completed), len(failed), len(blocked - failed - completed), len(remaining), len(qgraph)
+    )
+
+    outputs = defaultdict(set)
+    for node in remaining:
+        for dataset_type, refs in node.quantum.outputs.items():
+            outputs[dataset_type.name] |= {ref.id for ref in refs}
+    partial_outputs = []
+    for dataset_type_name, ids in outputs.items():
+        partial_outputs.extend(ref for ref in butler.registry.queryDatasets(dataset_type_name, collections=run) if ref.id in ids)
+    if partial_outputs:
+        logger.info("pruning %d partial outputs of the remaining quanta from %s", len(partial_outputs), run)
+        butler.pruneDatasets(partial_outputs, disassociate=True, unstore=True, purge=True)
+
+    return qgraph.subset(remaining)
+
+def pipeline_files(path, seen=None):
+    """
+    Return the pipeline definition at ``path`` and every pipeline and config
+    file it imports, recursively
+    """
+    import yaml
+
+    seen = seen if seen is not None else []
+    path = os.path.expandvars(path)
+    if path in seen:
+        return seen
+    seen.append(path)
+    with open(path) as f:
+        definition = yaml.safe_load(f) or {}
+
+    imports = definition.get("imports", [])
+    if isinstance(imports, (str, dict)):
+        imports = [imports]
+    for i in imports:
+        pipeline_files(i["location"] if isinstance(i, dict) else i, seen)
+
+    for task in (definition.get("tasks") or {}).values():
+        if not isinstance(task, dict):
+            continue
+        configs = task.get("config", [])
+        for config in configs if isinstance(configs, list) else [configs]:
+            if isinstance(config, dict) and "file" in config:
+                for config_file in ensure_iterable(config["file"]):
+                    seen.append(os.path.expandvars(config_file))
+    return seen
+
+def stack_version():
+    # eups records the version of every package that is set up in SETUP_* variables
+    import lsst.pipe.base
+    setup = sorted(f"{k}={v}" for k, v in os.environ.items() if k.startswith("SETUP_"))
+    return ";".join([getattr(lsst.pipe.base, "__version__", "")] + setup)
+
+def parse_config(override):
+    label, _, assignment = override.partition(":")
+    key, _, value = assignment.partition("=")
+    if not (label and key and value):
+        raise ValueError(f"config override {override} is not of the form label:key=value")
+    return label, key, value
+
+def load_pipeline(uri, config=()):
+    pipeline = Pipeline.from_uri(uri)
+    for label, key, value in config:
+        pipeline.addConfigOverride(label, key, value)
+    return pipeline
+
+def pipeline_graph_cache_key(uri, butler, repo=None, config=()):
+    h = hashlib.sha256()
+    path, _, subset = uri.partition("#")
+    for filename in pipeline_files(path):
+        h.update(filename.encode())
+        with open(filename, "rb") as f:
+            h.update(f.read())
+    h.update(subset.encode())
+    h.update(repr(list(config)).encode())
+    h.update(stack_version().encode())
+    # dataset types are resolved against the repository
+    h.update(repo_identity(repo).encode())
+    h.update(str(butler.dimensions.version).encode())
+    return h.hexdigest()
+
+def estimate_resources(butler, qgraph, collections, samples=20):
+    """
+    Estimate the CPU time and peak memory of a quantum of each task in a
+    quantum graph from the ``*_metadata`` of up to ``samples`` quanta of the
+    same task that already ran in ``collections``
+
+    Returns a dictionary of task label to a dictionary with the mean CPU
+    seconds, peak resident memory in bytes and number of quanta sampled;
+    tasks that have not run before are left out.
+    """
+    import itertools
+    from lsst.daf.butler.registry import MissingDatasetTypeError
+
+    estimates = {}
+    for task_def in qgraph.iterTaskGraph():
+        try:
+            refs = list(itertools.islice(
+                butler.registry.queryDatasets(task_def.metadataDatasetName, collections=collections), samples
+            ))
+        except MissingDatasetTypeError:
+            continue
+        cpu = []
+        memory = []
+        for ref in refs:
+            quantum = butler.get(ref)["quantum"]
+            try:
+                cpu.append(quantum["endCpuTime"] - quantum["startCpuTime"])
+                memory.append(quantum["endMaxResidentSetSize"])
+            except KeyError:
+                continue
+        if cpu:
+            estimates[task_def.label] = dict(cpu=sum(cpu) / len(cpu), memory=max(memory), samples=len(cpu))
+    return estimates
+
+def report(qgraph, estimates, file=None, max_values=10):
+    """
+    Print the quanta of each task and of each value of its dimensions, with
+    the CPU-hours and peak memory estimated from prior runs
+    """
+    total_cpu = 0
+    for task_def in qgraph.iterTaskGraph():
+        nodes = qgraph.getNodesForTask(task_def)
+        line = f"{task_def.label}: {len(nodes)} quanta"
+        estimate = estimates.get(task_def.label)
+        if estimate:
+            cpu = estimate['cpu'] * len(nodes) / 3600
+            total_cpu += cpu
+            line += (
+                f", {cpu:.1f} CPU-hours ({estimate['cpu']:.1f} s per quantum),"
+                f" peak memory {estimate['memory'] / 1024**3:.2f} GB"
+                f" from {estimate['samples']} prior quanta"
+            )
+        else:
+            line += ", no prior runs to estimate from"
+        print(line, file=file)
+
+        counts = defaultdict(lambda : defaultdict(int))
+        for node in nodes:
+            for dimension, value in node.quantum.dataId.required.items():
+                counts[dimension][value] += 1
+        for dimension, values in counts.items():
+            if len(values) <= max_values:
+                per_value = ", ".join(f"{v}={n}" for v, n in sorted(values.items()))
+            else:
+                n = sorted(values.values())
+                per_value = f"min {n[0]}, median {n[len(n) // 2]}, max {n[-1]} quanta per value"
+            print(f"  {dimension}: {len(values)} values ({per_value})", file=file)
+    print(f"total: {len(qgraph)} quanta, at least {total_cpu:.1f} CPU-hours", file=file)
+
+def memory_ladder(spec=None):
+    """
+    Parse the memory in MB requested for quanta after each successive
+    out-of-memory failure, e.g. "8192,16384,32768"
+    """
+    spec = spec or os.environ.get("PROC_DECAM_MEMORY_LADDER", "8192,16384,32768,65536")
+    return [int(x) for x in spec.split(",") if x]
+
+def escalations(qgraph, failures):
+    """
+    Return the largest number of recorded failures of a quantum of each task
+    in the graph, given failures keyed by (task, data ID key)
+    """
+    from .state import data_id_key
+
+    attempts = {}
+    if not failures:
+        return attempts
+    tasks = {task for task, _ in failures}
+    for task_def in qgraph.iterTaskGraph():
+        if task_def.label not in tasks:
+            continue
+        for node in qgraph.getNodesForTask(task_def):
+            n = failures.get((task_def.label, data_id_key(node.quantum.dataId)), 0)
+            if n > attempts.get(task_def.label, 0):
+                attempts[task_def.label] = n
+    return attempts
+
+def write_bps_config(path, estimates, include=None, headroom=1.2, attempts=None, ladder=None):
+    """
+    Write a bps config requesting the estimated memory and run time of each
+    task, with ``headroom``, that includes the submit config ``include``
+
+    Tasks with quanta that ran out of memory ``n`` times before request at
+    least the ``n``-th rung of ``ladder`` (the last rung once it is exceeded).
+    """
+    import yaml
+
+    attempts = attempts or {}
+    ladder = ladder or memory_ladder()
+    requests = {
+        label: int(headroom * estimate['memory'] / 1024**2)
+        for label, estimate in estimates.items()
+    }
+    for label, n in attempts.items():
+        rung = ladder[min(n, len(ladder)) - 1]
+        if rung > requests.get(label, 0):
+            logger.info("escalating %s to %d MB after %d out of memory failures", label, rung, n)
+            requests[label] = rung
+
+    config = {}
+    if include:
+        config["includeConfigs"] = [include]
+    config["pipetask"] = {label: dict(requestMemory=memory) for label, memory in requests.items()}
+    # lets sites keep long running quanta off preemptible blocks
+    for label, estimate in estimates.items():
+        config["pipetask"][label]["requestWalltime"] = int(headroom * estimate['cpu'])
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+
+def default_pipeline_cache_dir():
+    return os.environ.get(
+        "PROC_DECAM_PIPELINE_CACHE",
+        os.path.join(os.path.expanduser("~"), ".proc-decam", "pipeline-cache")
+    )
+
+def load_pipeline_graph(uri, butler, repo=None, cache_dir=None, config=()):
+    """
+    Load the pipeline at ``uri`` as a PipelineGraph resolved against the
+    butler's registry with the ``config`` overrides of (label, key, value),
+    reusing a graph saved earlier when neither the pipeline files, the subset,
+    the overrides nor the stack have changed
+    """
+    cache_dir = cache_dir or default_pipeline_cache_dir()
+    try:
+        key = pipeline_graph_cache_key(uri, butler, repo=repo, config=config)
+    except OSError as e:
+        logger.warning("not caching pipeline graph of %s: %s", uri, e)
+        key = None
+
+    # PipelineGraph._read_uri and _write_uri are not a stable part of the
+    # pipe_base API, so the cache is skipped when they are missing or cannot
+    # read a cached graph, e.g. after the serialization format changed
+    if key is not None:
+        path = os.path.join(cache_dir, key + ".json.gz")
+        if os.path.exists(path):
+            logger.info("loading cached pipeline graph %s", path)
+            try:
+                return PipelineGraph._read_uri(path)
+            except Exception as e:
+                logger.warning("could not read cached pipeline graph %s, rebuilding it: %s", path, e)
+
+    pipeline_graph = load_pipeline(uri, config).to_graph()
+    pipeline_graph.resolve(butler.registry)
+
+    if key is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        logger.info("caching pipeline graph to %s", path)
+        tmp = os.path.join(cache_dir, f"{key}.{os.getpid()}.json.gz")
+        try:
+            pipeline_graph._write_uri(tmp)
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.warning("not caching pipeline graph of %s: %s", uri, e)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return pipeline_graph
+
+def default_cache_dir():
+    return os.environ.get(
+        "PROC_DECAM_QGRAPH_CACHE",
+        os.path.join(os.path.expanduser("~"), ".proc-decam", "qgraph-cache")
+    )
+
+def collections_fingerprint(butler, pipeline_graph, collections):
+    """
+    Fingerprint the state of input collections by the runs they resolve to and
+    the number of datasets of each dataset type of the pipeline in them
+
+    New runs appended to a chain, or datasets added to or removed from a run,
+    change the fingerprint.
+    """
+    from lsst.daf.butler.registry import MissingDatasetTypeError
+
+    pipeline_graph.resolve(butler.registry)
+    h = hashlib.sha256()
+    collections = list(ensure_iterable(collections))
+    for name in butler.registry.queryCollections(collections, flattenChains=True):
+        h.update(name.encode())
+    for dataset_type_name in sorted(pipeline_graph.dataset_types.keys()):
+        try:
+            count = butler.registry.queryDatasets(dataset_type_name, collections=collections).count()
+        except MissingDatasetTypeError:
+            count = 0
+        h.update(f"{dataset_type_name}:{count}".encode())
+    return h.hexdigest()
+
+def repo_identity(repo):
+    # local repositories are identified by their absolute path, so the same
+    # repo reached by different relative paths shares its cached graphs
+    return os.path.abspath(repo) if repo and os.path.exists(repo) else str(repo)
+
+def qgraph_cache_key(butler, pipeline_graph, input_collections, repo=None, skip_failures=True, skip_existing_in=None, where=None, attach_datastore_records=False):
+    """
+    Key a quantum graph on everything that determines its quanta other than
+    the output run
+    """
+    h = hashlib.sha256()
+    # the cache is shared by every repo, and graphs refer to its dataset IDs
+    h.update(repo_identity(repo).encode())
+    h.update(str(butler.dimensions.version).encode())
+    for label, task_node in sorted(pipeline_graph.tasks.items()):
+        h.update(label.encode())
+        h.update(task_node.task_class_name.encode())
+        h.update(task_node.get_config_str().encode())
+    h.update(repr((
+        list(ensure_iterable(input_collections)),
+        list(ensure_iterable(skip_existing_in)) if skip_existing_in else [],
+        where,
+        skip_failures,
+        attach_datastore_records,
+    )).encode())
+    h.update(collections_fingerprint(
+        butler, pipeline_graph,
+        list(ensure_iterable(input_collections)) + (list(ensure_iterable(skip_existing_in)) if skip_existing_in else []),
+    ).encode())
+    return h.hexdigest()
+
+def evict_cache(cache_dir, keep=16):
+    # quantum graphs can be large, so only the most recently used are kept
+    paths = sorted(glob.glob(os.path.join(cache_dir, "*.qgraph")), key=os.path.getmtime, reverse=True)
+    for path in paths[keep:]:
+        logger.info("evicting cached quantum graph %s", path)
+        os.remove(path)
+
+def cached_qgraph(butler, pipeline_graph, input_collections, output_run=None, cache_dir=None, repo=None, **kwargs):
+    """
+    Build a quantum graph with create_qgraph, reusing a graph built earlier
+    from the same pipeline, query and input collection state
+
+    A reused graph has its output run replaced with ``output_run``.
+    """
+    cache_dir = cache_dir or default_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    key = qgraph_cache_key(
+        butler, pipeline_graph, input_collections,
+        repo=repo,
+        skip_failures=kwargs.get("skip_failures", True),
+        skip_existing_in=kwargs.get("skip_existing_in"),
+        where=kwargs.get("where"),
+        attach_datastore_records=kwargs.get("attach_datastore_records", False),
+    )
+    path = os.path.join(cache_dir, key + ".qgraph")
+    if os.path.exists(path):
+        logger.info("reusing cached quantum graph %s", path)
+        qgraph = QuantumGraph.loadUri(path)
+        if output_run:
+            qgraph.updateRun(output_run, metadata_key="output_run", update_graph_id=True)
+        os.utime(path)
+        return qgraph
+
+    qgraph = create_qgraph(butler, pipeline_graph, input_collections, output_run=output_run, **kwargs)
+    if len(qgraph) > 0:
+        logger.info("caching quantum graph to %s", path)
+        qgraph.saveUri(path + ".tmp")
+        os.replace(path + ".tmp", path)
+        evict_cache(cache_dir)
+    return qgraph
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-b", "--butler-config")
@@ -88,25 +570,86 @@ def main():
     parser.add_argument("-i", "--input")
     parser.add_argument("--output-run")
     parser.add_argument("-d", "--data-query")
+    parser.add_argument("-c", "--config", action="append", default=[], help="config override of a task, as label:key=value")
     parser.add_argument("--save-qgraph")
     parser.add_argument("--skip-existing-in")
     parser.add_argument("--skip-failures", action='store_true')
+    parser.add_argument("--qgraph-datastore-records", action='store_true')
+    parser.add_argument("--probe", action='store_true', help="only check for pending quanta, without building the graph")
+    parser.add_argument("--prune-qgraph", help="remove the completed quanta from a previously submitted graph instead of building one")
+    parser.add_argument("--qgraph-cache", default=None, help="directory of cached quantum graphs")
+    parser.add_argument("--no-qgraph-cache", action='store_true', help="always build the quantum graph")
+    parser.add_argument("--no-pipeline-cache", action='store_true', help="always expand the pipeline definition")
+    parser.add_argument("--report", action='store_true', help="report the quanta and estimated resources of each task")
+    parser.add_argument("--bps-config", help="write a bps config requesting the estimated memory of each task")
+    parser.add_argument("--bps-include", default=os.path.join(os.getcwd(), "pipelines", "submit.yaml"), help="bps config included by --bps-config")
+    parser.add_argument("--memory-ladder", default=None, help="comma separated memory in MB to request after each out of memory failure")
+    parser.add_argument("--state-db", default=os.path.join("runinfo", "state.db"), help="database recording the failures of quanta")
 
     args = parser.parse_args()
-    pipeline = Pipeline.from_uri(args.pipeline)
-    pipeline_graph = pipeline.to_graph()
+
+    def resources(butler, qgraph, collections):
+        if not (args.report or args.bps_config):
+            return
+        estimates = estimate_resources(butler, qgraph, collections)
+        if args.report:
+            report(qgraph, estimates)
+        if args.bps_config:
+            from .state import StateDB
+            attempts = escalations(qgraph, StateDB(args.state_db).failures("memory"))
+            logger.info("writing bps config to %s", args.bps_config)
+            write_bps_config(args.bps_config, estimates, include=args.bps_include, attempts=attempts, ladder=memory_ladder(args.memory_ladder))
+
+    if args.prune_qgraph:
+        butler = dafButler.Butler(args.butler_config, writeable=True)
+        qgraph = prune_qgraph(butler, QuantumGraph.loadUri(args.prune_qgraph), skip_failures=args.skip_failures)
+        print("there are", len(qgraph), "tasks")
+        if len(qgraph) == 0:
+            raise Exception("quantum graph is empty")
+        resources(butler, qgraph, qgraph.metadata["input"])
+        if args.save_qgraph:
+            logger.info("saving quantum graph to %s", args.save_qgraph)
+            qgraph.saveUri(args.save_qgraph)
+        return
+
     butler = dafButler.Butler(args.butler_config)
-    qgraph = create_qgraph(
+    config = [parse_config(c) for c in args.config]
+    if args.no_pipeline_cache:
+        pipeline_graph = load_pipeline(args.pipeline, config).to_graph()
+    else:
+        pipeline_graph = load_pipeline_graph(args.pipeline, butler, repo=args.butler_config, config=config)
+
+    if args.probe:
+        pending = pending_quanta(
+            butler, pipeline_graph,
+            args.skip_existing_in or args.input,
+            where=args.data_query,
+            skip_failures=args.skip_failures,
+        )
+        for label, n in pending.items():
+            print(label, "unknown" if n is None else n, "pending")
+        if all(n == 0 for n in pending.values()):
+            raise Exception("quantum graph is empty")
+        return
+
+    build = create_qgraph if args.no_qgraph_cache else partial(cached_qgraph, cache_dir=args.qgraph_cache, repo=args.butler_config)
+    qgraph = build(
         butler, pipeline_graph, 
         args.input,
         where=args.data_query,
         output_run=args.output_run,
         skip_existing_in=args.skip_existing_in,
         skip_failures=args.skip_failures,
+        attach_datastore_records=args.qgraph_datastore_records,
+        metadata=dict(butler_argument=args.butler_config),
     )
     print("there are", len(qgraph), "tasks")
     if len(qgraph) == 0:
         raise Exception("quantum graph is empty")
+    resources(butler, qgraph, args.skip_existing_in or args.input)
+    if args.save_qgraph:
+        logger.info("saving quantum graph to %s", args.save_qgraph)
+        qgraph.saveUri(args.save_qgraph)
 
 if __name__ == "__main__":
     main()
@@ -53,10 +53,12 @@ def main():
     import astropy.table
     import os
     from subprocess import Popen
+    from .budget import Budget
 
     parser = argparse.ArgumentParser()
     parser.add_argument("repo")
     parser.add_argument("exposures")
+    parser.add_argument("--processes", "-J", type=int, default=24, help="processes for each of the three refcat imports")
 
     args = parser.parse_args()
 
@@ -87,12 +89,16 @@ def main():
         )
     ]
     paths = exposures['path']
-    
+
+    # the three imports run at the same time, so share a single lease between them
+    lease = Budget().acquire(3 * args.processes, minimum=3)
+    processes = str(lease.cores // 3)
+
     cmd = [
         "lsst-refcats",
         "ps1",
         "--import-file",
-        "-J", "24",
+        "-J", processes,
         "--paths",
     ] + list(map(str, paths))
     with open("data/refcats_ps1.out", "w") as o, open("data/refcats_ps1.err", "w") as e:
@@ -102,7 +108,7 @@ def main():
         "lsst-refcats",
         "gaia_dr3",
         "--import-file",
-        "-J", "24",
+        "-J", processes,
         "--paths",
     ] + list(map(str, paths))
     with open("data/refcats_gaia_dr3.out", "w") as o, open("data/refcats_gaia_dr3.err", "w") as e:
@@ -112,7 +118,7 @@ def main():
         "lsst-refcats",
         "gaia_dr2",
         "--import-file",
-        "-J", "24",
+        "-J", processes,
         "--paths",
     ] + list(map(str, paths))
     with open("data/refcats_gaia_dr2.out", "w") as o, open("data/refcats_gaia_dr2.err", "w") as e:
@@ -121,6 +127,7 @@ def main():
     ps1.wait()
     gaia_dr3.wait()
     gaia_dr2.wait()
+    lease.release()
 
     for shortname, dataset in [("ps1", "ps1_pv3_3pi_20170110"), ("gaia_dr2", "gaia_dr2_20200414"), ("gaia_dr3", "gaia_dr3_20230707")]:
         cmd = [
@@ -1,61 +1,147 @@
 import lsst.daf.butler as dafButler
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
 import re
 import sys
+from .state import StateDB, data_id_key
 
-def check_for_retries(butler, run):
-    retry_regexes = [
-        re.compile(".*MemoryError: std::bad_alloc.*"),
-        re.compile(".*ValueError: Failure from formatter.*std::bad_alloc.*"),
-        re.compile(".*MemoryError: Unable to allocate.*"),
-        re.compile(".*MemoryError.*"),
-        re.compile(".*RuntimeError: Failed to serialize dataset.*")
-    ]
-    
-    refs = set(list(butler.registry.queryDatasets("*_log", collections=run)))
+# MemoryError also covers std::bad_alloc and "Unable to allocate" failures
+retry_regex = re.compile(
+    "(?P<memory>MemoryError|ValueError: Failure from formatter.*std::bad_alloc)"
+    "|(?P<serialize>RuntimeError: Failed to serialize dataset)"
+)
+
+def failed_logs(butler, run):
+    """
+    Return the logs of quanta in a run that have no metadata, i.e. that failed
+    """
+    refs = []
+    for log_type in butler.registry.queryDatasetTypes("*_log"):
+        logs = {ref.dataId: ref for ref in butler.registry.queryDatasets(log_type, collections=run)}
+        if not logs:
+            continue
+        metadata_type = log_type.name[:-len("_log")] + "_metadata"
+        if butler.registry.queryDatasetTypes(metadata_type):
+            completed = {ref.dataId for ref in butler.registry.queryDatasets(metadata_type, collections=run)}
+        else:
+            completed = set()
+        refs.extend(ref for data_id, ref in logs.items() if data_id not in completed)
+    return refs
+
+def failure_class(butler, ref):
+    """
+    Return the class of a retryable failure in a log, "memory" or
+    "serialize", or None
+    """
+    log = butler.get(ref)
+    for record in log:
+        m = retry_regex.search(record.message)
+        if m is not None:
+            return m.lastgroup
+    return None
+
+def iter_retries(butler, run, workers=16):
+    """
+    Yield the logs of failed quanta in a run whose failure can be retried,
+    with the class of failure, as the logs are fetched concurrently
+    """
+    refs = failed_logs(butler, run)
+    print("checking", len(refs), "failed quanta", file=sys.stderr)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(failure_class, butler, ref): ref for ref in refs}
+        for future in as_completed(futures):
+            if (cls := future.result()) is not None:
+                yield futures[future], cls
+
+def check_for_retries(butler, run, workers=16, state=None):
+    """
+    Return the logs of failed quanta in a run that can be retried, recording
+    their failures in ``state`` if given
+    """
     retries = []
-    for ref in refs:
-        log = butler.get(ref)
-        for record in log:
-            if any([regex.match(record.message) for regex in retry_regexes]):
-                print("ref needs retry", ref, file=sys.stderr)
-                retries.append(ref)
-                break
-                
+    failures = []
+    for ref, cls in iter_retries(butler, run, workers=workers):
+        print("ref needs retry", ref, cls, file=sys.stderr)
+        retries.append(ref)
+        failures.append((ref.datasetType.name[:-len("_log")], data_id_key(ref.dataId), cls))
+    if state is not None and failures:
+        state.record_failures(failures)
     return retries
 
-def copy_ref(butler, ref, run, _from, to):
-    datasetType = ref.datasetType.__class__(
-        ref.datasetType.name.replace(_from, to), 
-        ref.datasetType.dimensions, 
-        ref.datasetType.storageClass
+def relabel_type(dataset_type, _from, to):
+    return dataset_type.__class__(
+        dataset_type.name.replace(_from, to), 
+        dataset_type.dimensions, 
+        dataset_type.storageClass
     )
-    if len(butler.registry.queryDatasetTypes(datasetType.name)) == 0:
-        print("registering", datasetType)
-        butler.registry.registerDatasetType(datasetType)    
-    existing = list(map(lambda x : x.dataId, butler.registry.queryDatasets(datasetType, dataId=ref.dataId, collections=run)))
-    if ref.dataId not in existing:
-        print("moving", ref.datasetType, "to", datasetType)
-        butler.put(butler.get(ref), datasetType, dataId=ref.dataId, run=run)
+
+def register_relabelled_types(butler, refs, _from, to):
+    """
+    Register the types of ``refs`` renamed from ``_from`` to ``to``
+
+    Registering a type creates tables, which cannot happen inside a
+    transaction, so this is done before copying.
+    """
+    for datasetType in {ref.datasetType for ref in refs}:
+        relabelled = relabel_type(datasetType, _from, to)
+        if butler.registry.registerDatasetType(relabelled):
+            print("registering", relabelled)
+
+def copy_refs(butler, refs, run, _from, to):
+    """
+    Copy the files of ``refs`` into ``run`` as datasets of the types renamed
+    from ``_from`` to ``to``, unless they already exist there
+
+    The renamed types must already be registered (see
+    register_relabelled_types). Each is checked for existing datasets once,
+    and the files are ingested with a datastore copy rather than read and
+    written again.
+    """
+    from collections import defaultdict
+
+    by_type = defaultdict(list)
+    for ref in refs:
+        by_type[ref.datasetType.name].append(ref)
+
+    datasets = []
+    for refs in by_type.values():
+        datasetType = relabel_type(refs[0].datasetType, _from, to)
+        existing = {ref.dataId for ref in butler.registry.queryDatasets(datasetType, collections=run)}
+        moving = [ref for ref in refs if ref.dataId not in existing]
+        print("moving", len(moving), refs[0].datasetType, "to", datasetType)
+        datasets.extend(
+            dafButler.FileDataset(
+                path=butler.getURI(ref),
+                refs=[dafButler.DatasetRef(datasetType, ref.dataId, run=run)],
+            )
+            for ref in moving
+        )
+
+    if datasets:
+        butler.ingest(*datasets, transfer="copy")
     
 def move_refs(butler, refs, run, _from, to):
-    to_prune = []
-    for ref in refs:
-        copy_ref(butler, ref, run, _from, to)
-        to_prune.append(ref)
-    if len(to_prune) > 0:
-        print("pruning", to_prune, file=sys.stderr)
-        butler.pruneDatasets(to_prune, disassociate=True, unstore=True, purge=True)
+    refs = list(refs)
+    if len(refs) > 0:
+        register_relabelled_types(butler, refs, _from, to)
+        with butler.transaction():
+            copy_refs(butler, refs, run, _from, to)
+            print("pruning", len(refs), "datasets", file=sys.stderr)
+            butler.pruneDatasets(refs, disassociate=True, unstore=True, purge=True)
     
 def get_metadata_refs(butler, refs, run):
-    return sum(
-        [list(
-            butler.registry.queryDatasets(
-                ref.datasetType.name.replace("_log", "_metadata"),
-                dataId=ref.dataId,
-                collections=run
-            )
-        ) for ref in refs], []
-    )
+    from collections import defaultdict
+
+    data_ids = defaultdict(set)
+    for ref in refs:
+        data_ids[ref.datasetType.name.replace("_log", "_metadata")].add(ref.dataId)
+    metadata_refs = []
+    for metadata_type, ids in data_ids.items():
+        metadata_refs.extend(
+            ref for ref in butler.registry.queryDatasets(metadata_type, collections=run)
+            if ref.dataId in ids
+        )
+    return metadata_refs
     
 
 def main():
@@ -63,11 +149,13 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("repo")
     parser.add_argument("run")
+    parser.add_argument("--workers", "-J", type=int, default=16, help="logs fetched concurrently")
+    parser.add_argument("--state-db", default=os.path.join("runinfo", "state.db"), help="database recording the failures of quanta")
     
     args = parser.parse_args()
 
     butler = dafButler.Butler(args.repo, writeable=True)
-    retries = check_for_retries(butler, args.run)
+    retries = check_for_retries(butler, args.run, workers=args.workers, state=StateDB(args.state_db))
     print("need to retry", len(retries), "tasks", file=sys.stderr)
     move_refs(butler, retries, args.run, "_log", "_log_retry")
 
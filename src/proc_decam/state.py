@@ -0,0 +1,109 @@
+"""
+Local state of completed workflow steps and failed quanta
+
+Each completed step is recorded under a key made from its command, the keys
+of the steps it depends on and a fingerprint of the files it reads, so a
+re-run workflow can skip steps that already completed with the same inputs.
+Quanta that failed in a retryable way are recorded by task, data ID and
+failure class, so later submissions can give them more resources.
+"""
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+def fingerprint_files(paths):
+    """
+    Fingerprint files by their path, size and modification time
+    """
+    h = hashlib.sha256()
+    for path in sorted(map(str, paths)):
+        h.update(path.encode())
+        try:
+            stat = os.stat(path)
+            h.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+        except FileNotFoundError:
+            h.update(b"missing")
+    return h.hexdigest()
+
+def step_key(cmd, dep_keys=(), files=()):
+    h = hashlib.sha256()
+    h.update(cmd.encode())
+    for key in sorted(dep_keys):
+        h.update(key.encode())
+    if files:
+        h.update(fingerprint_files(files).encode())
+    return h.hexdigest()
+
+def data_id_key(data_id):
+    return json.dumps({k: data_id[k] for k in sorted(data_id.required.keys())}, default=str)
+
+class StateDB():
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS steps (key TEXT PRIMARY KEY, name TEXT, cmd TEXT, completed REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS failures (task TEXT, data_id TEXT, class TEXT, attempts INTEGER, updated REAL, PRIMARY KEY (task, data_id, class))"
+            )
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # a connection per call, since completion is recorded from Parsl's
+        # callback threads, committed and then closed
+        with contextlib.closing(sqlite3.connect(self.path, timeout=60)) as conn, conn:
+            yield conn
+
+    def completed(self, keys):
+        """
+        Return the subset of ``keys`` that are recorded as complete
+        """
+        keys = list(keys)
+        done = set()
+        with self._connect() as conn:
+            # stay below sqlite's limit on the number of query parameters
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = conn.execute(
+                    f"SELECT key FROM steps WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                )
+                done.update(row[0] for row in rows)
+        return done
+
+    def mark_complete(self, key, name, cmd):
+        logger.debug("marking %s complete", name)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO steps (key, name, cmd, completed) VALUES (?, ?, ?, ?)",
+                (key, name, cmd, time.time()),
+            )
+
+    def record_failures(self, failures):
+        """
+        Count another failure of each (task, data ID key, failure class)
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO failures (task, data_id, class, attempts, updated) VALUES (?, ?, ?, 1, ?) "
+                "ON CONFLICT (task, data_id, class) DO UPDATE SET attempts = attempts + 1, updated = excluded.updated",
+                [(task, data_id, failure_class, now) for task, data_id, failure_class in failures],
+            )
+
+    def failures(self, failure_class):
+        """
+        Return the number of failures of ``failure_class`` recorded for each
+        (task, data ID key)
+        """
+        with self._connect() as conn:
+            rows = conn.execute("SELECT task, data_id, attempts FROM failures WHERE class = ?", (failure_class,))
+            return {(task, data_id): attempts for task, data_id, attempts in rows}
@@ -0,0 +1,100 @@
+import os
+
+import lsst.afw.image as afwImage
+import lsst.pex.config as pexConfig
+import lsst.pipe.base as pipeBase
+from lsst.ip.diffim.getTemplate import GetTemplateConfig, GetTemplateConnections, GetTemplateTask
+
+from ..templates import TemplateCacheStats, cache_key, default_cache_dir, evict_cache
+
+class CachedGetTemplateConfig(GetTemplateConfig, pipelineConnections=GetTemplateConnections):
+    doCache = pexConfig.Field(
+        dtype=bool,
+        doc="Reuse templates warped for earlier visits onto the same detector WCS",
+        default=True,
+    )
+    cacheDir = pexConfig.Field(
+        dtype=str,
+        doc="Directory of the template cache; empty for $PROC_DECAM_TEMPLATE_CACHE or ~/.proc-decam/template-cache",
+        default="",
+    )
+    wcsTolerance = pexConfig.Field(
+        dtype=float,
+        doc="Sky positions of the detector corners must agree within this many arcseconds to reuse a template",
+        default=0.01,
+    )
+    maxCacheSize = pexConfig.Field(
+        dtype=float,
+        doc="Size of the cache in GB beyond which the least recently used templates are evicted",
+        default=100.0,
+    )
+    evictEvery = pexConfig.Field(
+        dtype=float,
+        doc="GB written to the cache between checks of its size against maxCacheSize",
+        default=1.0,
+    )
+
+class CachedGetTemplateTask(GetTemplateTask):
+    """
+    Warp the coadds onto a detector, reusing the template warped for an
+    earlier visit when the detector's WCS agrees with it within tolerance
+    """
+    ConfigClass = CachedGetTemplateConfig
+    _DefaultName = "cachedGetTemplate"
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._cachePath = None
+        self._cacheStats = None
+
+    def runQuantum(self, butlerQC, inputRefs, outputRefs):
+        if not self.config.doCache:
+            return super().runQuantum(butlerQC, inputRefs, outputRefs)
+
+        cache_dir = self.config.cacheDir or default_cache_dir()
+        data_id = butlerQC.quantum.dataId
+        bbox = butlerQC.get(inputRefs.bbox)
+        wcs = butlerQC.get(inputRefs.wcs)
+        coadd_ids = [ref.id for ref in inputRefs.coaddExposures]
+        # the cache settings do not change the template, so only the warping
+        # and coadd selection configuration is part of the key
+        config = repr(sorted(
+            (k, str(v)) for k, v in self.config.toDict().items()
+            if k not in ("doCache", "cacheDir", "wcsTolerance", "maxCacheSize", "evictEvery")
+        ))
+        key = cache_key(coadd_ids, data_id["detector"], bbox, wcs, self.config.wcsTolerance, config)
+        path = os.path.join(cache_dir, key + ".fits")
+
+        stats = TemplateCacheStats(cache_dir)
+        hit = os.path.exists(path)
+        # getTemplate quanta have visit and detector dimensions
+        stats.record(key, data_id["detector"], data_id["visit"], hit)
+        self.metadata["cacheHit"] = hit
+        if hit:
+            self.log.info("reusing cached template %s", path)
+            template = afwImage.ExposureF.readFits(path)
+            template.setWcs(wcs)
+            os.utime(path)
+            butlerQC.put(pipeBase.Struct(template=template), outputRefs)
+            return
+
+        self._cachePath = path
+        self._cacheStats = stats
+        try:
+            super().runQuantum(butlerQC, inputRefs, outputRefs)
+        finally:
+            self._cachePath = None
+            self._cacheStats = None
+
+    def run(self, *args, **kwargs):
+        results = super().run(*args, **kwargs)
+        if self._cachePath is not None:
+            os.makedirs(os.path.dirname(self._cachePath), exist_ok=True)
+            # write then rename so concurrent quanta never read a partial template
+            tmp = f"{self._cachePath}.{os.getpid()}.tmp"
+            results.template.writeFits(tmp)
+            os.replace(tmp, self._cachePath)
+            # the cache directory is only scanned every evictEvery GB written
+            if self._cacheStats.record_write(os.path.getsize(self._cachePath), self.config.evictEvery * 1024**3):
+                evict_cache(os.path.dirname(self._cachePath), self.config.maxCacheSize)
+        return results
@@ -0,0 +1,269 @@
+import math
+
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+import lsst.geom as geom
+import lsst.pex.config as pexConfig
+import lsst.pipe.base as pipeBase
+import lsst.pipe.base.connectionTypes as cT
+from lsst.meas.algorithms import CoaddPsf, CoaddPsfConfig
+from lsst.pipe.tasks.coaddBase import makeSkyInfo
+from lsst.pipe.tasks.coaddInputRecorder import CoaddInputRecorderTask
+from lsst.skymap import BaseSkyMap
+
+statistics = ["mean", "median", "meanclip", "min"]
+
+class MultiStatisticAssembleCoaddConnections(
+    pipeBase.PipelineTaskConnections,
+    dimensions=("tract", "patch", "band", "skymap"),
+    defaultTemplates={"inputCoaddName": "deep", "outputCoaddName": "deep", "warpType": "direct"},
+):
+    inputWarps = cT.Input(
+        doc="Warps of the patch to be coadded",
+        name="{inputCoaddName}Coadd_{warpType}Warp",
+        storageClass="ExposureF",
+        dimensions=("tract", "patch", "skymap", "visit", "instrument"),
+        deferLoad=True,
+        multiple=True,
+    )
+
+    skyMap = cT.Input(
+        doc="Skymap that defines the patch",
+        name=BaseSkyMap.SKYMAP_DATASET_TYPE_NAME,
+        storageClass="SkyMap",
+        dimensions=("skymap",),
+    )
+
+    meanCoadd = cT.Output(
+        doc="Mean of the warps",
+        name="{outputCoaddName}Coadd_mean",
+        storageClass="ExposureF",
+        dimensions=("tract", "patch", "skymap", "band"),
+    )
+
+    medianCoadd = cT.Output(
+        doc="Median of the warps",
+        name="{outputCoaddName}Coadd_median",
+        storageClass="ExposureF",
+        dimensions=("tract", "patch", "skymap", "band"),
+    )
+
+    meanclipCoadd = cT.Output(
+        doc="Sigma clipped mean of the warps",
+        name="{outputCoaddName}Coadd_meanclip",
+        storageClass="ExposureF",
+        dimensions=("tract", "patch", "skymap", "band"),
+    )
+
+    minCoadd = cT.Output(
+        doc="Minimum of the warps",
+        name="{outputCoaddName}Coadd_min",
+        storageClass="ExposureF",
+        dimensions=("tract", "patch", "skymap", "band"),
+    )
+
+    def __init__(self, *, config=None):
+        super().__init__(config=config)
+        for statistic in statistics:
+            if statistic not in config.statistics:
+                delattr(self, f"{statistic}Coadd")
+
+class MultiStatisticAssembleCoaddConfig(pipeBase.PipelineTaskConfig, pipelineConnections=MultiStatisticAssembleCoaddConnections):
+    statistics = pexConfig.ListField(
+        dtype=str,
+        doc=f"Statistics to coadd the warps with, any of {statistics}",
+        default=statistics,
+        itemCheck=lambda x : x in statistics,
+    )
+    badMaskPlanes = pexConfig.ListField(
+        dtype=str,
+        doc="Mask planes of warp pixels left out of the coadds",
+        default=["NO_DATA", "BAD", "SAT"],
+    )
+    sigmaClip = pexConfig.Field(
+        dtype=float,
+        doc="Clipping threshold of the clipped mean in standard deviations",
+        default=3.0,
+    )
+    clipIter = pexConfig.Field(
+        dtype=int,
+        doc="Clipping iterations of the clipped mean",
+        default=2,
+    )
+    stripeHeight = pexConfig.Field(
+        dtype=int,
+        doc="Rows of the patch coadded at a time; 0 to derive them from maxMemory",
+        default=0,
+    )
+    maxMemory = pexConfig.Field(
+        dtype=float,
+        doc="Memory in MB for the warp pixels read at a time when stripeHeight is 0; 0 to read whole warps",
+        default=0,
+    )
+    inputRecorder = pexConfig.ConfigurableField(
+        doc="Records the inputs of the coadds",
+        target=CoaddInputRecorderTask,
+    )
+    coaddPsf = pexConfig.ConfigField(
+        doc="Configuration of the coadd PSFs",
+        dtype=CoaddPsfConfig,
+    )
+
+class MultiStatisticAssembleCoaddTask(pipeBase.PipelineTask):
+    """
+    Coadd the warps of a patch with several statistics, reading each warp once
+
+    Warps are weighted by their inverse mean variance, as in
+    AssembleCoaddTask, but no CompareWarp artifact rejection is done, so the
+    mean and clipped mean coadds are not the same as those of
+    ``mean-template.yaml`` and ``meanclip-template.yaml``: transients and
+    artifacts present in a single warp are only removed by the clipped mean
+    and the median.
+    """
+    _DefaultName = "multiStatisticAssembleCoadd"
+    ConfigClass = MultiStatisticAssembleCoaddConfig
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.makeSubtask("inputRecorder")
+
+    def runQuantum(self, butlerQC, inputRefs, outputRefs):
+        inputs = butlerQC.get(inputRefs)
+        data_id = butlerQC.quantum.dataId
+        skyInfo = makeSkyInfo(inputs["skyMap"], data_id["tract"], data_id["patch"])
+        outputs = self.run(inputs["inputWarps"], skyInfo)
+        butlerQC.put(outputs, outputRefs)
+
+    def makeStatsCtrl(self):
+        statsCtrl = afwMath.StatisticsControl()
+        statsCtrl.setNumSigmaClip(self.config.sigmaClip)
+        statsCtrl.setNumIter(self.config.clipIter)
+        statsCtrl.setAndMask(afwImage.Mask.getPlaneBitMask(self.config.badMaskPlanes))
+        statsCtrl.setNanSafe(True)
+        statsCtrl.setCalcErrorFromInputVariance(True)
+        return statsCtrl
+
+    def stripeRows(self, nWarps, bbox):
+        if self.config.stripeHeight > 0:
+            return self.config.stripeHeight
+        if self.config.maxMemory > 0:
+            # image, mask and variance planes of 4 bytes each
+            row = 12 * bbox.getWidth() * max(nWarps, 1)
+            return max(1, int(self.config.maxMemory * 1024**2 // row))
+        return bbox.getHeight()
+
+    def computeWeight(self, handle, statsCtrl):
+        """
+        The inverse of the clipped mean variance of the good pixels of a warp,
+        reading only its mask and variance planes
+        """
+        mask = handle.get(component="mask")
+        variance = handle.get(component="variance")
+        stats = afwMath.makeStatistics(variance, mask, afwMath.MEANCLIP, statsCtrl)
+        meanVar, _ = stats.getResult(afwMath.MEANCLIP)
+        if not math.isfinite(meanVar) or meanVar <= 0:
+            return None
+        return 1.0 / meanVar
+
+    def recordInputs(self, inputWarps, statsCtrl):
+        """
+        Weight the warps, record the inputs of the coadds and find the
+        bounding box of each warp, reading one warp's mask and variance at a
+        time and only a pixel of its image
+
+        Warps without a usable weight are left out.
+        """
+        coaddInputs = self.inputRecorder.makeCoaddInputs()
+        handles = []
+        bboxes = []
+        weights = []
+        first = None
+        for handle in inputWarps:
+            weight = self.computeWeight(handle, statsCtrl)
+            if weight is None:
+                self.log.warning("skipping warp %s without a valid mean variance", handle.dataId)
+                continue
+            bbox = handle.get(component="bbox")
+            warp = handle.get(parameters={"bbox": geom.Box2I(bbox.getMin(), geom.Extent2I(1, 1))})
+            self.inputRecorder.addVisitToCoadd(coaddInputs, warp, weight)
+            handles.append(handle)
+            bboxes.append(bbox)
+            weights.append(weight)
+            if first is None:
+                first = warp
+        coaddInputs.visits.sort()
+        coaddInputs.ccds.sort()
+        return coaddInputs, handles, bboxes, weights, first
+
+    def readStripe(self, inputWarps, bboxes, weights, stripe):
+        """
+        Read the pixels of each warp within ``stripe``, padding warps that
+        only partly cover it with NO_DATA, and return them with their weights
+        """
+        noData = afwImage.Mask.getPlaneBitMask("NO_DATA")
+        images = []
+        stripeWeights = []
+        for handle, bbox, weight in zip(inputWarps, bboxes, weights):
+            overlap = stripe.clippedTo(bbox)
+            if overlap.isEmpty():
+                continue
+            image = handle.get(parameters={"bbox": overlap}).getMaskedImage()
+            if overlap != stripe:
+                padded = afwImage.MaskedImageF(stripe)
+                padded.image.array[:] = math.nan
+                padded.mask.array[:] = noData
+                padded.variance.array[:] = math.nan
+                padded.assign(image, overlap)
+                image = padded
+            images.append(image)
+            stripeWeights.append(weight)
+        return images, stripeWeights
+
+    def run(self, inputWarps, skyInfo):
+        """
+        Coadd the warps with each statistic
+
+        The patch is coadded in stripes of rows, reading only the part of
+        each warp within the stripe, so the memory needed is set by the
+        stripe size (and the mask and variance of one warp, read to weight
+        it) rather than the number of warps.
+        """
+        if len(inputWarps) == 0:
+            raise pipeBase.NoWorkFound("no warps to coadd")
+
+        bbox = skyInfo.patchInfo.getOuterBBox()
+        statsCtrl = self.makeStatsCtrl()
+        coaddInputs, inputWarps, bboxes, weights, first = self.recordInputs(inputWarps, statsCtrl)
+        if not inputWarps:
+            raise pipeBase.NoWorkFound("no warps with a valid weight to coadd")
+        statsCtrl.setWeighted(True)
+        psf = CoaddPsf(coaddInputs.ccds, skyInfo.wcs, self.config.coaddPsf.makeControl())
+
+        coadds = {}
+        for statistic in self.config.statistics:
+            coadd = afwImage.ExposureF(bbox, skyInfo.wcs)
+            coadd.setPhotoCalib(first.getPhotoCalib())
+            coadd.setFilter(first.getFilter())
+            coadd.getInfo().setCoaddInputs(coaddInputs)
+            coadd.setPsf(psf)
+            coadds[statistic] = coadd
+
+        rows = self.stripeRows(len(inputWarps), bbox)
+        self.log.info("coadding %d warps with %s in stripes of %d rows", len(inputWarps), self.config.statistics, rows)
+        for y in range(bbox.getMinY(), bbox.getMaxY() + 1, rows):
+            stripe = geom.Box2I(
+                geom.Point2I(bbox.getMinX(), y),
+                geom.Extent2I(bbox.getWidth(), min(rows, bbox.getMaxY() + 1 - y)),
+            )
+            images, stripeWeights = self.readStripe(inputWarps, bboxes, weights, stripe)
+            for statistic, coadd in coadds.items():
+                view = afwImage.MaskedImageF(coadd.getMaskedImage(), stripe)
+                if not images:
+                    view.image.array[:] = math.nan
+                    view.mask.array[:] = afwImage.Mask.getPlaneBitMask("NO_DATA")
+                    continue
+                view.assign(afwMath.statisticsStack(
+                    images, afwMath.stringToStatisticsProperty(statistic.upper()), statsCtrl, stripeWeights
+                ))
+
+        return pipeBase.Struct(**{f"{statistic}Coadd": coadd for statistic, coadd in coadds.items()})
@@ -0,0 +1,151 @@
+"""
+A cache of templates warped onto detector WCSs for image differencing
+
+DEEP revisits the same pointings night after night, so the template that
+`getTemplate` warps onto a detector is often the same as one warped for an
+earlier visit. Templates are cached on disk by the coadds they were made
+from, the detector, its bounding box and its WCS quantized to a tolerance;
+visits whose WCS agrees with a cached template within the tolerance reuse it
+instead of re-warping the coadds.
+
+Each lookup is recorded in a sqlite database in the cache directory, from
+which `proc-decam templates` reports the hit rate.
+"""
+import contextlib
+import glob
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+import time
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+def default_cache_dir():
+    return os.environ.get(
+        "PROC_DECAM_TEMPLATE_CACHE",
+        os.path.join(os.path.expanduser("~"), ".proc-decam", "template-cache")
+    )
+
+def wcs_fingerprint(wcs, bbox, tolerance):
+    """
+    Fingerprint a WCS by the sky positions of the corners and center of
+    ``bbox``, rounded to ``tolerance`` arcseconds
+    """
+    import lsst.geom as geom
+
+    corners = [geom.Point2D(p) for p in bbox.getCorners()] + [geom.Box2D(bbox).getCenter()]
+    rounded = []
+    for point in corners:
+        sky = wcs.pixelToSky(point)
+        dec = sky.getDec().asArcseconds()
+        ra = sky.getRa().asArcseconds() * math.cos(sky.getDec().asRadians())
+        rounded.append((round(ra / tolerance), round(dec / tolerance)))
+    return repr(rounded)
+
+def cache_key(coadd_ids, detector, bbox, wcs, tolerance, config=""):
+    h = hashlib.sha256()
+    for coadd_id in sorted(map(str, coadd_ids)):
+        h.update(coadd_id.encode())
+    h.update(repr((detector, bbox.getMinX(), bbox.getMinY(), bbox.getWidth(), bbox.getHeight())).encode())
+    h.update(wcs_fingerprint(wcs, bbox, tolerance).encode())
+    h.update(config.encode())
+    return h.hexdigest()
+
+def evict_cache(cache_dir, max_size):
+    # templates of detectors that are no longer observed age out first
+    paths = sorted(glob.glob(os.path.join(cache_dir, "*.fits")), key=os.path.getmtime, reverse=True)
+    size = 0
+    for path in paths:
+        try:
+            size += os.path.getsize(path)
+            if size > max_size * 1024**3:
+                logger.info("evicting cached template %s", path)
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+class TemplateCacheStats():
+    def __init__(self, cache_dir):
+        self.path = os.path.join(cache_dir, "stats.db")
+        os.makedirs(cache_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS lookups (time REAL, key TEXT, detector INTEGER, visit INTEGER, hit INTEGER)"
+            )
+            # bytes written to the cache since it was last evicted
+            conn.execute("CREATE TABLE IF NOT EXISTS written (bytes INTEGER)")
+            conn.execute("INSERT INTO written (bytes) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM written)")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # quanta on many workers record their lookups concurrently, each with
+        # a connection that is committed and then closed
+        with contextlib.closing(sqlite3.connect(self.path, timeout=60)) as conn, conn:
+            yield conn
+
+    def record(self, key, detector, visit, hit):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO lookups (time, key, detector, visit, hit) VALUES (?, ?, ?, ?, ?)",
+                (time.time(), key, detector, visit, int(hit)),
+            )
+
+    def record_write(self, nbytes, threshold):
+        """
+        Count ``nbytes`` written to the cache, returning whether more than
+        ``threshold`` bytes were written since the last eviction, in which
+        case the count starts again and the caller should evict
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            written = conn.execute("SELECT bytes FROM written").fetchone()[0] + nbytes
+            evict = written > threshold
+            conn.execute("UPDATE written SET bytes = ?", (0 if evict else written,))
+        return evict
+
+    def summary(self, since=None):
+        """
+        Return the number of lookups and hits, in total and by detector,
+        since the unix time ``since``
+        """
+        since = since or 0
+        with self._connect() as conn:
+            lookups, hits = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(hit), 0) FROM lookups WHERE time >= ?", (since,)
+            ).fetchone()
+            detectors = conn.execute(
+                "SELECT detector, COUNT(*), SUM(hit) FROM lookups WHERE time >= ? GROUP BY detector ORDER BY detector", (since,)
+            ).fetchall()
+        return lookups, hits, detectors
+
+def main():
+    import argparse
+    import datetime
+
+    parser = argparse.ArgumentParser(prog="proc-decam templates")
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--since", default=None, help="only count lookups since this date (YYYY-MM-DD)")
+    parser.add_argument("--by-detector", action="store_true")
+    parser.add_argument("--evict", type=float, default=None, help="evict templates until the cache is at most this size in GB")
+
+    args = parser.parse_args()
+
+    cache_dir = args.cache_dir or default_cache_dir()
+    if args.evict is not None:
+        evict_cache(cache_dir, args.evict)
+
+    since = datetime.datetime.fromisoformat(args.since).timestamp() if args.since else None
+    lookups, hits, detectors = TemplateCacheStats(cache_dir).summary(since)
+    paths = glob.glob(os.path.join(cache_dir, "*.fits"))
+    size = sum(os.path.getsize(path) for path in paths)
+    rate = hits / lookups if lookups else 0
+    print(f"{cache_dir}: {len(paths)} templates ({size / 1024**3:.1f} GB), {hits} of {lookups} lookups hit ({rate:.1%})")
+    if args.by_detector:
+        for detector, n, h in detectors:
+            print(f"  detector {detector}: {h} of {n} ({h / n:.1%})")
+
+if __name__ == "__main__":
+    main()
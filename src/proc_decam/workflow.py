@@ -0,0 +1,192 @@
+"""
+A declarative graph of command line steps that is submitted as a Parsl workflow
+
+Each step names the steps it depends on, so independent steps run concurrently
+and a step only waits on the outputs it consumes. Given a StateDB, completed
+steps are recorded and skipped when the workflow is run again. Steps given a
+Python function run it in the workflow's own process, on the thread pool
+executor returned by ``thread_executor``.
+
+A workflow started by a step of another (e.g. `proc-decam pipeline` run by
+`proc-decam night`) inherits that step's key through the
+PROC_DECAM_PARENT_KEY environment variable and folds it into its own keys,
+so its steps are re-run whenever the step that started it is.
+"""
+import logging
+import os
+import uuid
+from functools import partial
+import parsl
+from parsl import bash_app, python_app
+from parsl.executors import ThreadPoolExecutor
+from .parsl import run_command
+from .state import step_key
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+thread_executor_label = "threads"
+parent_key_variable = "PROC_DECAM_PARENT_KEY"
+
+def thread_executor(max_threads=4):
+    return ThreadPoolExecutor(label=thread_executor_label, max_threads=max_threads)
+
+class Step():
+    def __init__(self, name, cmd, deps=(), cost=1, files=(), func=None, memoize=True):
+        self.name = name
+        self.cmd = cmd
+        self.deps = list(deps)
+        self.cost = cost
+        self.files = list(files)
+        self.func = func
+        self.memoize = memoize
+
+    def __repr__(self):
+        return f"Step({self.name!r}, deps={self.deps!r})"
+
+class StepGraph():
+    def __init__(self, parent_key=None):
+        self.steps = {}
+        self.parent_key = parent_key if parent_key is not None else os.environ.get(parent_key_variable)
+
+    def add(self, name, cmd, deps=(), cost=1, files=(), func=None, memoize=True):
+        """
+        Add a step running the command ``cmd`` after the steps named in ``deps``
+
+        ``cmd`` may be a string or a list of arguments. Dependencies that are
+        ``None`` are ignored, so optional upstream steps can be passed directly.
+        ``files`` are the files read by the step, which are fingerprinted when
+        deciding whether a completed step can be skipped. With ``func``, the
+        step calls it instead of running ``cmd``, which should then be the
+        equivalent command. Steps whose result depends on state the key
+        cannot see, such as the registry, are created with ``memoize=False``
+        and are never skipped, nor are the steps downstream of them. Returns
+        the name of the step.
+        """
+        if name in self.steps:
+            raise ValueError(f"step {name} already exists")
+        deps = [d for d in deps if d is not None]
+        for d in deps:
+            if d not in self.steps:
+                raise ValueError(f"step {name} depends on unknown step {d}")
+        if not isinstance(cmd, str):
+            cmd = " ".join(map(str, cmd))
+        self.steps[name] = Step(name, cmd, deps=deps, cost=cost, files=files, func=func, memoize=memoize)
+        return name
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __contains__(self, name):
+        return name in self.steps
+
+    def __getitem__(self, name):
+        return self.steps[name]
+
+    def order(self):
+        # steps can only depend on steps added before them
+        return list(self.steps.keys())
+
+    def critical_path(self):
+        """
+        Return the chain of steps with the largest total cost and that cost
+        """
+        total = {}
+        previous = {}
+        for name in self.order():
+            step = self.steps[name]
+            best = None
+            for d in step.deps:
+                if best is None or total[d] > total[best]:
+                    best = d
+            previous[name] = best
+            total[name] = step.cost + (total[best] if best is not None else 0)
+
+        if not total:
+            return [], 0
+
+        name = max(total, key=lambda x : total[x])
+        cost = total[name]
+        path = []
+        while name is not None:
+            path.append(name)
+            name = previous[name]
+        return path[::-1], cost
+
+    def print_critical_path(self, file=None):
+        path, cost = self.critical_path()
+        print(f"critical path ({len(path)} of {len(self)} steps, cost {cost}):", file=file)
+        for name in path:
+            print(f"  {name}: {self.steps[name].cmd}", file=file)
+
+    def keys(self):
+        """
+        Return the completion key of each step, which changes when its
+        command, the files it reads, any of its upstream steps or the key of
+        the parent step that started this workflow change
+        """
+        keys = {}
+        for name in self.order():
+            step = self.steps[name]
+            dep_keys = [keys[d] for d in step.deps]
+            if not step.deps and self.parent_key:
+                dep_keys = [self.parent_key]
+            keys[name] = step_key(step.cmd, dep_keys, step.files)
+        return keys
+
+    def submit(self, state=None, resume=True):
+        """
+        Submit each step as a bash_app to the loaded DataFlowKernel
+
+        With a StateDB, steps are recorded there as they complete and, when
+        resuming, a step is skipped if it and all of its upstream steps
+        already completed. Returns a dictionary of step name to future, which
+        is None for skipped steps.
+        """
+        keys = self.keys()
+        completed = state.completed(keys.values()) if (state is not None and resume) else set()
+        # commands run on the workflow's other executors
+        labels = [label for label in parsl.dfk().executors if label not in (thread_executor_label, "_parsl_internal")]
+
+        futures = {}
+        skipped = set()
+        for name in self.order():
+            step = self.steps[name]
+            if step.memoize and keys[name] in completed and all(d in skipped for d in step.deps):
+                logger.info("skipping completed step %s", name)
+                skipped.add(name)
+                futures[name] = None
+                continue
+
+            inputs = [futures[d] for d in step.deps if futures[d] is not None]
+            if step.func is not None:
+                func = partial(_call, step.func)
+                setattr(func, "__name__", name)
+                future = python_app(func, executors=[thread_executor_label])(inputs=inputs)
+            else:
+                func = partial(run_command)
+                setattr(func, "__name__", name)
+                future = bash_app(func, executors=labels)(command(step, keys[name]), inputs=inputs)
+            if state is not None and step.memoize:
+                future.add_done_callback(partial(_record, state, keys[name], name, step.cmd))
+            futures[name] = future
+
+        if skipped:
+            logger.info("skipped %d of %d completed steps", len(skipped), len(self))
+        return futures
+
+def command(step, key):
+    """
+    The command of a step, passing its key to any workflow it starts
+
+    Steps that are not memoized pass a fresh key, so nested workflows never
+    skip their steps either.
+    """
+    return f"{parent_key_variable}={key if step.memoize else uuid.uuid4().hex} {step.cmd}"
+
+def _call(func, inputs=()):
+    return func()
+
+def _record(state, key, name, cmd, future):
+    if future.exception() is None:
+        state.mark_complete(key, name, cmd)
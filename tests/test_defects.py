@@ -0,0 +1,60 @@
+"""
+Tests that the defect boxes of a mask reproduce it exactly
+"""
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("requests")
+
+from proc_decam.defects import boxes_to_mask, mask_to_boxes
+
+def check(mask):
+    mask = np.asarray(mask, dtype=bool)
+    boxes = mask_to_boxes(mask)
+    assert np.array_equal(boxes_to_mask(mask.shape, boxes), mask)
+
+    # every set pixel is covered by exactly one box
+    covered = np.zeros(mask.shape, dtype=int)
+    for x0, y0, width, height in zip(*boxes):
+        assert width > 0 and height > 0
+        covered[y0:y0 + height, x0:x0 + width] += 1
+    assert covered.max(initial=0) <= 1
+    return boxes
+
+@pytest.mark.parametrize("seed", range(50))
+def test_random(seed):
+    rng = np.random.default_rng(seed)
+    shape = tuple(rng.integers(1, 64, size=2))
+    check(rng.random(shape) < rng.random())
+
+def test_random_with_bad_columns():
+    rng = np.random.default_rng(0)
+    mask = rng.random((4096, 2048)) < 1e-4
+    mask[:, 100:103] = True
+    mask[10:4000, 500] = True
+    x0, _, _, _ = check(mask)
+    assert len(x0) < mask.sum() / 10
+
+def test_empty():
+    x0, _, _, _ = check(np.zeros((20, 30), dtype=bool))
+    assert len(x0) == 0
+
+def test_full():
+    x0, y0, width, height = check(np.ones((20, 30), dtype=bool))
+    assert list(zip(x0, y0, width, height)) == [(0, 0, 30, 20)]
+
+def test_single_row_run():
+    mask = np.zeros((10, 10), dtype=bool)
+    mask[4, 2:8] = True
+    x0, y0, width, height = check(mask)
+    assert list(zip(x0, y0, width, height)) == [(2, 4, 6, 1)]
+
+def test_single_column_run():
+    mask = np.zeros((10, 10), dtype=bool)
+    mask[1:9, 3] = True
+    x0, y0, width, height = check(mask)
+    assert list(zip(x0, y0, width, height)) == [(3, 1, 1, 8)]
+
+def test_single_pixel_image():
+    check(np.ones((1, 1), dtype=bool))
+    check(np.zeros((1, 1), dtype=bool))
@@ -0,0 +1,121 @@
+"""
+Tests of preemption handling and routing of the Klone bps site, with sbatch
+and squeue mocked out
+"""
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("parsl")
+pytest.importorskip("lsst.ctrl.bps.parsl")
+
+from lsst.ctrl.bps import BpsConfig
+from parsl.app.errors import BashExitFailure
+from parsl.executors.high_throughput.errors import WorkerLost
+from parsl.jobs.states import JobState
+
+from proc_decam.parsl.providers import KloneCheckpointProvider
+from proc_decam.parsl.sites.klone import Klone, is_preemption
+
+def make_site(**values):
+    config = BpsConfig({
+        "computeSite": "klone",
+        "site": {"klone": {"class": "proc_decam.parsl.sites.Klone", **values}},
+    })
+    return Klone(config)
+
+def make_job(request_walltime=None, request_memory=None):
+    return SimpleNamespace(generic=SimpleNamespace(request_walltime=request_walltime, request_memory=request_memory))
+
+class FakeSlurm():
+    """
+    Answers sbatch with a job ID and squeue/sacct with the state of that job
+    """
+    def __init__(self, job_id="1234"):
+        self.job_id = job_id
+        self.state = "PD"
+        self.commands = []
+
+    def execute_wait(self, cmd, *args, **kwargs):
+        self.commands.append(cmd)
+        if cmd.startswith("sbatch"):
+            return 0, f"Submitted batch job {self.job_id}", ""
+        if "squeue" in cmd or "sacct" in cmd:
+            return 0, f"{self.job_id} {self.state}", ""
+        return 0, "", ""
+
+def mock_slurm(provider, tmp_path, monkeypatch):
+    slurm = FakeSlurm()
+    provider.script_dir = str(tmp_path)
+    # parsl runs commands through a channel in older versions and directly in newer ones
+    if getattr(provider, "channel", None) is not None:
+        monkeypatch.setattr(provider.channel, "execute_wait", slurm.execute_wait)
+        monkeypatch.setattr(provider.channel, "script_dir", str(tmp_path), raising=False)
+    else:
+        monkeypatch.setattr(provider, "execute_wait", slurm.execute_wait)
+    return slurm
+
+def test_preempted_block_is_requeued(tmp_path, monkeypatch):
+    site = make_site(max_preemptions=1)
+    executor = next(executor for executor in site.get_executors() if executor.label == "ckpt")
+    provider = executor.provider
+    assert isinstance(provider, KloneCheckpointProvider)
+    slurm = mock_slurm(provider, tmp_path, monkeypatch)
+
+    job_id = provider.submit("process_worker_pool.py", 1, job_name="ckpt")
+    assert job_id == slurm.job_id
+    assert any(cmd.startswith("sbatch") for cmd in slurm.commands)
+    slurm.state = "R"
+    assert provider.status([job_id])[0].state == JobState.RUNNING
+
+    # slurm preempts the block, so the job running on it loses its worker,
+    # or its command is killed by SIGTERM
+    slurm.state = "PREEMPTED" if any("sacct" in cmd for cmd in slurm.commands) else "PR"
+    assert provider.status([job_id])[0].state != JobState.RUNNING
+    task_record = {"id": 1}
+    for exception in [WorkerLost(0, "n3001"), BashExitFailure("pipetask", 143)]:
+        assert is_preemption(exception)
+    # the first preemption is requeued at no cost against retries
+    assert site.retry_handler(WorkerLost(0, "n3001"), task_record) == 0
+    assert task_record["preemptions"] == 1
+    # one more than max_preemptions is counted
+    assert site.retry_handler(BashExitFailure("pipetask", 143), task_record) == 1
+
+def test_is_preemption():
+    assert is_preemption(WorkerLost(0, "n3001"))
+    assert is_preemption(BashExitFailure("pipetask", 143))
+    assert is_preemption(BashExitFailure("pipetask", -15))
+    assert not is_preemption(BashExitFailure("pipetask", 1))
+    assert not is_preemption(ValueError("failed"))
+
+def test_retry_handler_requeues_preemptions():
+    site = make_site(max_preemptions=2)
+    task_record = {"id": 1}
+    assert site.retry_handler(WorkerLost(0, "n3001"), task_record) == 0
+    assert site.retry_handler(BashExitFailure("pipetask", 143), task_record) == 0
+    assert task_record["preemptions"] == 2
+    # preemptions beyond max_preemptions count against retries
+    assert site.retry_handler(WorkerLost(0, "n3001"), task_record) == 1
+
+def test_retry_handler_counts_failures():
+    site = make_site()
+    task_record = {"id": 1}
+    assert site.retry_handler(BashExitFailure("pipetask", 1), task_record) == 1
+    assert "preemptions" not in task_record
+
+def test_select_executor():
+    site = make_site(cores_per_node=8, mem_per_node=64, ckpt_max_runtime=7200)
+    assert site.select_executor(make_job()) == "ckpt"
+    assert site.select_executor(make_job(request_walltime="3600", request_memory=4096)) == "ckpt"
+    # long jobs are kept off preemptible blocks
+    assert site.select_executor(make_job(request_walltime="10800")) == "astro"
+    # as are jobs needing more memory than a ckpt worker has
+    assert site.select_executor(make_job(request_memory=16384)) == "astro"
+
+def test_select_executor_defaults():
+    site = make_site()
+    # half of the checkpoint walltime and the memory of a single-core worker
+    assert site.select_executor(make_job(request_walltime=2 * 3600)) == "ckpt"
+    assert site.select_executor(make_job(request_walltime=2 * 3600 + 1)) == "astro"
+    assert site.select_executor(make_job(request_memory=8192)) == "ckpt"
+    assert site.select_executor(make_job(request_memory=8193)) == "astro"
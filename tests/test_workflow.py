@@ -0,0 +1,104 @@
+"""
+Tests of skipping completed steps of nested workflows
+"""
+import time
+
+import pytest
+
+parsl = pytest.importorskip("parsl")
+
+from parsl.executors import ThreadPoolExecutor
+
+from proc_decam.state import StateDB
+from proc_decam.workflow import StepGraph, command, parent_key_variable, thread_executor
+
+@pytest.fixture
+def dfk(tmp_path):
+    config = parsl.Config(
+        executors=[ThreadPoolExecutor(label="local"), thread_executor()],
+        run_dir=str(tmp_path / "runinfo"),
+    )
+    parsl.load(config)
+    yield parsl.dfk()
+    parsl.dfk().cleanup()
+
+@pytest.fixture(autouse=True)
+def no_parent_key(monkeypatch):
+    monkeypatch.delenv(parent_key_variable, raising=False)
+
+def outer_graph(exposures):
+    # as proc-decam night runs proc-decam pipeline after ingesting exposures
+    graph = StepGraph()
+    graph.add("ingest", "true", files=[exposures])
+    graph.add("pipeline", "true", deps=["ingest"])
+    return graph
+
+def inner_graph(parent_key):
+    graph = StepGraph(parent_key=parent_key)
+    graph.add("execute_step1", "true")
+    graph.add("execute_step2", "true", deps=["execute_step1"])
+    return graph
+
+def run(graph, state):
+    futures = graph.submit(state=state)
+    for future in futures.values():
+        if future:
+            future.result()
+    # completion is recorded by callbacks that may finish after the result
+    keys = [key for name, key in graph.keys().items() if graph[name].memoize]
+    for _ in range(100):
+        if len(state.completed(keys)) == len(keys):
+            break
+        time.sleep(0.05)
+    return {name for name, future in futures.items() if future is not None}
+
+def test_inner_steps_rerun_when_parent_changes(tmp_path, dfk):
+    state = StateDB(str(tmp_path / "state.db"))
+    exposures = tmp_path / "exposures.ecsv"
+    exposures.write_text("night\n20190401\n")
+
+    parent = outer_graph(exposures).keys()["pipeline"]
+    assert run(inner_graph(parent), state) == {"execute_step1", "execute_step2"}
+    # nothing upstream changed, so the inner workflow is complete
+    assert run(inner_graph(parent), state) == set()
+
+    # more exposures are ingested, which changes the key of the pipeline step
+    exposures.write_text("night\n20190401\n20190402\n")
+    changed = outer_graph(exposures).keys()["pipeline"]
+    assert changed != parent
+    assert run(inner_graph(changed), state) == {"execute_step1", "execute_step2"}
+
+def test_parent_key_inherited(monkeypatch):
+    graph = StepGraph()
+    graph.add("step", "true")
+
+    monkeypatch.setenv(parent_key_variable, "a")
+    a = StepGraph()
+    a.add("step", "true")
+    monkeypatch.setenv(parent_key_variable, "b")
+    b = StepGraph()
+    b.add("step", "true")
+
+    assert len({graph.keys()["step"], a.keys()["step"], b.keys()["step"]}) == 3
+
+def test_command_passes_key():
+    graph = StepGraph()
+    graph.add("memoized", "proc-decam pipeline")
+    graph.add("registry", "proc-decam associate", memoize=False)
+    keys = graph.keys()
+
+    assert command(graph["memoized"], keys["memoized"]) == f"{parent_key_variable}={keys['memoized']} proc-decam pipeline"
+    # a step that is never skipped passes a fresh key each time
+    assert command(graph["registry"], keys["registry"]) != command(graph["registry"], keys["registry"])
+
+def test_unmemoized_steps_rerun(tmp_path, dfk):
+    state = StateDB(str(tmp_path / "state.db"))
+
+    def graph():
+        graph = StepGraph()
+        graph.add("associate", "true", memoize=False)
+        graph.add("execute", "true", deps=["associate"])
+        return graph
+
+    assert run(graph(), state) == {"associate", "execute"}
+    assert run(graph(), state) == {"associate", "execute"}